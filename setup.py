@@ -11,7 +11,7 @@ setup(
     url='https://github.com/riffm/testalchemy',
     description='A set of utility classes for testing code that uses sqlalchemy',
     license='MIT',
-    install_requires=['sqlalchemy'],
+    install_requires=['sqlalchemy<2.0'],
     py_modules=['testalchemy'],
     test_suite='tests',
     platforms='Any'
@@ -1,22 +1,471 @@
 # -*- coding: utf-8 -*-
 
+import os
+import re
+import sys
+import json
+import errno
+import base64
+import decimal
+import numbers
+import datetime
+import time
 import types
-from sqlalchemy import event
-from sqlalchemy.orm import util, Session
+import shutil
+import pickle
+import random
+import hashlib
+import inspect
+import marshal
+import sqlite3
+import zlib
+import tempfile
+import weakref
+import threading
+from itertools import islice
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from sqlalchemy import event, exc, func, and_, or_, select, bindparam, \
+        create_engine, Table, Column, MetaData, BigInteger, Sequence
+from sqlalchemy.pool import StaticPool, SingletonThreadPool
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.sql import table as table_clause, column as column_clause
+from sqlalchemy.orm import util, attributes, Session, sessionmaker, \
+        class_mapper, object_mapper, ColumnProperty, RelationshipProperty, \
+        make_transient_to_detached
+from sqlalchemy.orm.interfaces import MANYTOONE, ONETOMANY
+from sqlalchemy.sql.util import sort_tables, find_tables
 try:
     from sqlalchemy.orm import ScopedSession
 except ImportError:
     from sqlalchemy.orm.scoping import scoped_session as ScopedSession
 
 try:
-    # Sqlalchemy >= 0.9
-    remove_event = event.remove
-except AttributeError:
-    # Sqlalchemy < 0.9
-    remove_event = event.Events._remove
+    # Sqlalchemy >= 1.4
+    from sqlalchemy.ext.asyncio import AsyncSession, async_scoped_session
+except ImportError:
+    AsyncSession = async_scoped_session = None
+
+
+__all__ = ['Sample', 'SampleCache', 'batch', 'seq', 'DatabasePool',
+           'SharedDatabase', 'Restorable', 'DBHistory', 'DBFingerprint',
+           'QueryCounter', 'QueryProfiler', 'clone_database', 'worker_id',
+           'dump_tables', 'dump_sample', 'load_tables']
+
+# SQLite refuses statements with more than 999 bound parameters, the lowest
+# limit among commonly used drivers
+MAX_PARAMS = 999
+# rows inserted with one executemany by bulk sample creation
+MAX_BULK_ROWS = 1000
+
+
+class _Dispatcher(object):
+    '''The only listener of an event on a target, calls handlers of active
+    recorders in order they were entered'''
+
+    def __init__(self):
+        self.handlers = ()
+
+    def __call__(self, *args, **kwargs):
+        for handler in self.handlers:
+            handler(*args, **kwargs)
+
+
+# Listening and removing of SQLAlchemy listeners rebuilds dispatch
+# collections, so dispatchers are installed once per target and event and
+# entering of recorders just adds handlers to them
+_dispatchers = weakref.WeakKeyDictionary()
+_dispatchers_lock = threading.Lock()
+
+
+def _listen(target, identifier, handler):
+    with _dispatchers_lock:
+        dispatchers = _dispatchers.setdefault(target, {})
+        dispatcher = dispatchers.get(identifier)
+        if dispatcher is None:
+            dispatcher = dispatchers[identifier] = _Dispatcher()
+            event.listen(target, identifier, dispatcher)
+        # handlers are replaced, not changed, to be iterated without lock
+        dispatcher.handlers += (handler,)
+
+
+def _unlisten(target, identifier, handler):
+    with _dispatchers_lock:
+        dispatcher = _dispatchers[target][identifier]
+        handlers = list(dispatcher.handlers)
+        # the last one, if the same recorder is entered several times
+        del handlers[len(handlers) - 1 - handlers[::-1].index(handler)]
+        dispatcher.handlers = tuple(handlers)
+
+
+def _session_bind(bind):
+    '''Returns (session, bind) of session, scoped session, engine or
+    connection, session is None for the latter two'''
+    if isinstance(bind, ScopedSession):
+        bind = bind.registry()
+    if isinstance(bind, Session):
+        return bind, bind.get_bind()
+    return None, bind
+
+
+def _in_memory(url):
+    return url.drivername.startswith('sqlite') and \
+            url.database in (None, '', ':memory:')
+
+
+def _make_engine(url):
+    if _in_memory(url):
+        # one connection keeps in-memory database alive
+        return create_engine(url, poolclass=StaticPool,
+                             connect_args={'check_same_thread': False})
+    return create_engine(url)
+
+
+def _thread_safe(bind):
+    '''Whether the bind can be used from another thread: connections can't,
+    in-memory SQLite database is separate for each thread'''
+    if not isinstance(bind, Engine):
+        return False
+    return not _in_memory(bind.url)
 
 
-__all__ = ['Sample', 'Restorable', 'DBHistory']
+def _row_hash(*values):
+    return zlib.crc32(repr(values).encode('utf-8')) & 0xffffffff
+
+
+def _row_hash_expression(dialect, columns):
+    '''SQL expression of 32-bit hash of row values, sums of such hashes
+    don't overflow'''
+    if dialect == 'sqlite':
+        # `_row_hash` function is registered for connection
+        return func.testalchemy_hash(*columns)
+    if dialect == 'mysql':
+        return func.crc32(func.concat_ws('|', *columns))
+    if dialect == 'postgresql':
+        return func.hashtext(func.concat_ws('|', *columns))
+    raise NotImplementedError('Row hashes are not supported for %s' %
+                              dialect)
+
+
+def _split_session(db):
+    '''Returns sync session and `AsyncSession` proxying it (or None)'''
+    if isinstance(db, ScopedSession):
+        return db.registry(), None
+    if async_scoped_session is not None and \
+            isinstance(db, async_scoped_session):
+        db = db.registry()
+    if AsyncSession is not None and isinstance(db, AsyncSession):
+        return db.sync_session, db
+    return db, None
+
+
+def _run_sync(async_db, func, *args):
+    '''Awaitable calling `func` in greenlet of `AsyncSession`, where sync
+    session can do IO'''
+    assert async_db is not None, 'AsyncSession is required'
+    return async_db.run_sync(lambda session: func(*args))
+
+
+def _begin(db):
+    # session in autocommit mode (removed in SQLAlchemy 2.0) begins
+    # transaction explicitly
+    if getattr(db, 'autocommit', False):
+        db.begin()
+
+
+def _chunks(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _pk_criterion(columns, idents):
+    if len(columns) == 1:
+        return columns[0].in_([ident[0] for ident in idents])
+    return or_(*[and_(*[column == value
+                        for column, value in zip(columns, ident)])
+                 for ident in idents])
+
+
+def _ident_positions(mapper, columns):
+    '''Positions of `columns` values in the identity of `mapper`'''
+    equivalents = mapper._equivalent_columns
+    positions = []
+    for column in columns:
+        for i, pk_column in enumerate(mapper.primary_key):
+            if column is pk_column or \
+                    column in equivalents.get(pk_column, ()):
+                positions.append(i)
+                break
+        else:
+            return None
+    return positions
+
+
+def _row_pk(mapper, table, ident):
+    positions = _ident_positions(mapper, list(table.primary_key.columns))
+    return tuple(ident[i] for i in positions)
+
+
+def _load_idents(session, model_cls, idents, max_params=MAX_PARAMS):
+    '''Returns set of instances for identities. Instances present in the
+    identity map are used as is, others are loaded with one query per chunk
+    of identities. Rows missing in the database are skipped.'''
+    objects = set()
+    missing = []
+    identity_map = session.identity_map
+    for ident in idents:
+        obj = identity_map.get(util.identity_key(model_cls, ident))
+        if obj is None:
+            missing.append(ident)
+        else:
+            objects.add(obj)
+    if missing:
+        pk_columns = class_mapper(model_cls).primary_key
+        size = max(1, max_params // len(pk_columns))
+        for chunk in _chunks(missing, size):
+            objects.update(session.query(model_cls)
+                           .filter(_pk_criterion(pk_columns, chunk)))
+    return objects
+
+
+_TABLE_RE = re.compile(r'\b(?:FROM|JOIN|INTO|UPDATE)\s+[`"\[]?(\w+)', re.I)
+# table written by textual INSERT, UPDATE, DELETE or REPLACE statement
+_DML_TABLE_RE = re.compile(r'^\s*(?:(?:INSERT|REPLACE)(?:\s+OR\s+\w+)?\s+INTO|'
+                           r'UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+'
+                           r'[`"\[]?(\w+)', re.I)
+
+
+def _statement_verb(statement):
+    return statement.lstrip().split(None, 1)[0].upper()
+
+
+def _statement_tables(statement, context):
+    '''Names of tables used by statement. Compiled statement is inspected
+    when available, textual SQL is parsed with regular expression.'''
+    compiled = getattr(context, 'compiled', None)
+    if compiled is not None:
+        tables = set(table.name for table in
+                     find_tables(compiled.statement, include_crud=True))
+        if tables:
+            return tables
+    return set(_TABLE_RE.findall(statement))
+
+
+_FINGERPRINT_SUBS = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'%\(\w+\)s|%s|:\w+'), '?'),
+    (re.compile(r'\s+'), ' '),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)'), '(?)'),
+    (re.compile(r'\(\?\)(?:\s*,\s*\(\?\))+'), '(?)'),
+]
+
+
+def _fingerprint(statement):
+    '''Normalizes SQL: literals and bound parameters are replaced with `?`,
+    lists of them are collapsed.'''
+    for pattern, replacement in _FINGERPRINT_SUBS:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+def _percentile(sorted_values, percent):
+    index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def _deletion_plan(history):
+    '''Groups identities by table and orders tables so that dependent rows
+    are deleted first. Returns list of (mapper, table, columns, idents).
+    Rows of subclass tables and many-to-many association tables are also
+    included.'''
+    plan = {}
+    def add(mapper, table, columns, positions, idents):
+        key = (table, tuple(columns))
+        rows = plan.setdefault(key, (mapper, set()))[1]
+        rows.update(tuple(ident[i] for i in positions) for ident in idents)
+    for cls, idents in history.items():
+        base_mapper = class_mapper(cls)
+        for mapper in base_mapper.self_and_descendants:
+            for table in mapper.tables:
+                columns = list(table.primary_key.columns)
+                positions = _ident_positions(mapper, columns)
+                if positions is not None:
+                    add(mapper, table, columns, positions, idents)
+            for prop in mapper.relationships:
+                if prop.secondary is None or prop.parent is not mapper:
+                    continue
+                for column, secondary_column in prop.synchronize_pairs:
+                    positions = _ident_positions(mapper, [column])
+                    if positions is not None:
+                        add(mapper, prop.secondary, [secondary_column],
+                            positions, idents)
+    order = sort_tables(set(table for table, columns in plan))
+    order = dict((table, i) for i, table in enumerate(order))
+    return [(mapper, table, columns, idents)
+            for (table, columns), (mapper, idents) in
+            sorted(plan.items(), key=lambda item: -order[item[0][0]])]
+
+
+def _column_key(mapper, column):
+    return mapper.get_property_by_column(column).key
+
+
+def _sync(source, source_mapper, dest, dest_mapper, pairs):
+    for source_column, dest_column in pairs:
+        setattr(dest, _column_key(dest_mapper, dest_column),
+                getattr(source, _column_key(source_mapper, source_column)))
+
+
+def _next_ids(db, mapper, count, taken=0):
+    '''Reserves `count` autoincrement primary keys of `mapper` table, so
+    rows can be inserted with executemany. Keys are taken from the sequence
+    on PostgreSQL and follow maximal existing one (and `taken`) for SQLite
+    and MySQL (it is supposed that nothing else writes to the table at the
+    same time). Returns None when keys can't be reserved.'''
+    table = mapper.local_table
+    column = table._autoincrement_column
+    if len(mapper.primary_key) != 1 or column is None or \
+            column is not mapper.primary_key[0]:
+        return None
+    dialect = db.get_bind(mapper).dialect.name
+    if dialect == 'postgresql':
+        if isinstance(column.default, Sequence):
+            sequence = column.default.name
+        else:
+            sequence = func.pg_get_serial_sequence(table.fullname,
+                                                   column.name)
+        return [row[0] for row in db.execute(
+            select([func.nextval(sequence)])
+            .select_from(func.generate_series(1, count)),
+            mapper=mapper)]
+    elif dialect in ('sqlite', 'mysql'):
+        start = db.execute(select([func.max(column)]),
+                           mapper=mapper).scalar() or 0
+        start = max(start, taken)
+        return list(range(start + 1, start + 1 + count))
+    return None
+
+
+def _reserve_ids(db, mapper, group, objects):
+    '''Assigns autoincrement primary keys to `objects` before insert.
+    Returns False when keys can't be reserved.'''
+    column = mapper.local_table._autoincrement_column
+    if column is None:
+        return False
+    key = _column_key(mapper, column)
+    # explicit keys of objects being inserted are taken into account
+    ids = _next_ids(db, mapper, len(objects),
+                    max([0] + [getattr(obj, key) or 0 for obj in group]))
+    if ids is None:
+        return False
+    for obj, ident in zip(objects, ids):
+        setattr(obj, key, ident)
+    return True
+
+
+def _bulk_insert(db, objects):
+    '''Inserts transient objects and related ones with executemany per
+    mapper in dependency order, foreign keys are synchronized from
+    relationships by hand. Objects are attached to session as persistent
+    ones afterwards. Returns inserted objects, empty list when they are left
+    to be flushed.'''
+    groups = {}
+    seen = set()
+    for obj in objects:
+        state = attributes.instance_state(obj)
+        states = [state]
+        if state.mapper.relationships:
+            states.extend(item[2] for item in
+                          state.mapper.cascade_iterator('save-update', state))
+        for state in states:
+            if state.key is not None or state in seen:
+                continue
+            seen.add(state)
+            groups.setdefault(state.mapper, []).append(state.obj())
+    relationships = [prop for mapper in groups
+                     for prop in mapper.relationships
+                     if not prop.viewonly and prop.parent is mapper]
+    if any(set(prop.mapper.tables) & set(prop.parent.tables)
+           for prop in relationships):
+        # self-referential rows need unit of work to be ordered
+        db.add_all(objects)
+        return []
+    order = sort_tables(set(t for mapper in groups for t in mapper.tables))
+    order = dict((table, i) for i, table in enumerate(order))
+    mappers = sorted(groups, key=lambda m: max(order[t] for t in m.tables))
+    for mapper in mappers:
+        group = groups[mapper]
+        for prop in mapper.relationships:
+            if prop.direction is not MANYTOONE or prop.viewonly:
+                continue
+            for obj in group:
+                target = obj.__dict__.get(prop.key)
+                if target is not None:
+                    _sync(target, prop.mapper, obj, mapper,
+                          prop.synchronize_pairs)
+        pk_keys = [_column_key(mapper, c) for c in mapper.primary_key]
+        missing = [obj for obj in group
+                   if any(getattr(obj, key) is None for key in pk_keys)]
+        if missing and _reserve_ids(db, mapper, group, missing):
+            missing = []
+        # objects without primary key are inserted one by one to get it
+        for chunk in _chunks(group, MAX_BULK_ROWS):
+            db.bulk_save_objects(chunk, return_defaults=bool(missing))
+        for prop in mapper.relationships:
+            if prop.direction is not ONETOMANY or prop.viewonly:
+                continue
+            for obj in group:
+                for child in obj.__dict__.get(prop.key) or ():
+                    _sync(obj, mapper, child, prop.mapper,
+                          prop.synchronize_pairs)
+    secondary_rows = {}
+    for prop in relationships:
+        if prop.secondary is None:
+            continue
+        rows = secondary_rows.setdefault(prop.secondary,
+                                         (prop.parent, set()))[1]
+        for obj in groups[prop.parent]:
+            for child in obj.__dict__.get(prop.key) or ():
+                row = {}
+                for column, secondary_column in prop.synchronize_pairs:
+                    row[secondary_column.key] = getattr(
+                        obj, _column_key(prop.parent, column))
+                for column, secondary_column in \
+                        prop.secondary_synchronize_pairs:
+                    row[secondary_column.key] = getattr(
+                        child, _column_key(prop.mapper, column))
+                rows.add(tuple(sorted(row.items())))
+    for table in sort_tables(secondary_rows):
+        mapper, rows = secondary_rows[table]
+        if rows:
+            db.execute(table.insert(), [dict(row) for row in rows],
+                       mapper=mapper)
+    inserted = [obj for mapper in mappers for obj in groups[mapper]]
+    for obj in inserted:
+        # bulk insert sets identity key without committing attributes
+        attributes.instance_state(obj).key = None
+        make_transient_to_detached(obj)
+    db.add_all(inserted)
+    return inserted
+
+
+# names of sample properties being materialized in current thread
+_materializing = threading.local()
+
+
+def _materializing_stack():
+    try:
+        return _materializing.stack
+    except AttributeError:
+        stack = _materializing.stack = []
+        return stack
 
 
 class sample_property(object):
@@ -29,115 +478,1334 @@ class sample_property(object):
     def __get__(self, inst, cls):
         if inst is None:
             return self
+        attrs = inst.__dict__
+        if self.name in attrs:
+            result = attrs[self.name]
+        else:
+            result = self._materialize(inst)
+        # record the edge only while another property is being created, so
+        # plain reads stay cheap
+        if attrs['_resolving'] and self.name in attrs['used_properties']:
+            attrs['dependencies'].setdefault(attrs['_resolving'][-1], set())\
+                    .add(self.name)
+        return result
+
+    def _materialize(self, inst):
+        stack = _materializing_stack()
+        stack.append('%s.%s' % (inst.__class__.__name__, self.name))
+        inst._resolving.append(self.name)
+        try:
+            result = self._create(inst)
+        finally:
+            inst._resolving.pop()
+            stack.pop()
+        inst.used_properties.add(self.name)
+        inst.__dict__[self.name] = result
+        return result
+
+    def __set__(self, inst, value):
+        inst.__dict__[self.name] = value
+
+    def __call__(self, obj):
+        return self.method(obj)
+
+    def _create(self, inst):
         result = self.method(inst)
-        if isinstance(result, (list, tuple)):
+        if isinstance(result, types.GeneratorType):
+            return inst._stream(result)
+        if inst._bulk_objects is not None:
+            if isinstance(result, (list, tuple)):
+                inst._bulk_objects.extend(result)
+            else:
+                inst._bulk_objects.append(result)
+        elif isinstance(result, (list, tuple)):
             inst.db.add_all(result)
         else:
             inst.db.add(result)
-        inst.used_properties.add(self.name)
-        setattr(inst, self.name, result)
         return result
 
+    def _renamed(self, name):
+        return sample_property(self.method, name=name)
+
+
+class seq(object):
+    '''Column value of n-th row in batch: `start + n` number or string
+    formatted from `pattern`'''
+
+    def __init__(self, pattern=None, start=0):
+        self.pattern = pattern
+        self.start = start
+
+    def __call__(self, n):
+        n += self.start
+        return n if self.pattern is None else self.pattern.format(n)
+
+    def __repr__(self):
+        return 'seq(%r, start=%r)' % (self.pattern, self.start)
+
+
+class batch(sample_property):
+    '''Sample property inserting `count` rows of `model` table with core
+    executemany statements, `chunk_size` rows at once. Values of keyword
+    arguments are constants or callables accepting row number (like `seq`).
+    Value of the property is the number of inserted rows.'''
+
+    def __init__(self, model, count, chunk_size=1000, **values):
+        self.model = model
+        self.count = count
+        self.chunk_size = chunk_size
+        self.values = values
+        self.name = None
+        self.__doc__ = 'Batch of %d %s rows' % (count, model.__name__)
+
     def __call__(self, obj):
-        return self.method(obj)
+        return self._create(obj)
 
+    def _create(self, inst):
+        mapper = class_mapper(self.model)
+        table = mapper.local_table
+        keys = [mapper.get_property(name).columns[0].key
+                for name in self.values]
+        values = self.values.values()
+        # previously added objects can be referenced by batch rows
+        if inst._bulk_objects:
+            inst._collect(_bulk_insert(inst.db, inst._bulk_objects))
+            del inst._bulk_objects[:]
+        inst.db.flush()
+        # primary keys not given are reserved, so identities of all
+        # inserted rows are recorded
+        pk_keys = [column.key for column in mapper.primary_key]
+        reserve = not set(pk_keys) <= set(keys)
+        idents = inst.created_idents.setdefault(self.model, set())
+        for start in range(0, self.count, self.chunk_size):
+            numbers = range(start, min(start + self.chunk_size, self.count))
+            columns = [[value(n) for n in numbers] if callable(value)
+                       else [value] * len(numbers)
+                       for value in values]
+            rows = [dict(zip(keys, row)) for row in zip(*columns)] \
+                if columns else [{} for n in numbers]
+            ids = _next_ids(inst.db, mapper, len(rows)) if reserve else None
+            if reserve and ids is None:
+                # keys are read back from rows inserted one by one
+                for row in rows:
+                    result = inst.db.execute(table.insert(), row,
+                                             mapper=mapper)
+                    idents.add(tuple(result.inserted_primary_key))
+                continue
+            if ids is not None:
+                for row, ident in zip(rows, ids):
+                    row[pk_keys[0]] = ident
+            inst.db.execute(table.insert(), rows, mapper=mapper)
+            idents.update(tuple(row[key] for key in pk_keys) for row in rows)
+        return self.count
 
-class Sample(object):
+    def _renamed(self, name):
+        renamed = batch(self.model, self.count, self.chunk_size,
+                        **self.values)
+        renamed.name = name
+        return renamed
 
-    class __metaclass__(type):
-        def __new__(cls, cls_name, bases, attributes):
-            self = type.__new__(cls, cls_name, bases, attributes)
-            for name in dir(self):
-                if name.startswith('_') or name == 'create_all':
-                    continue
-                value = getattr(self, name)
-                if isinstance(value, types.MethodType):
-                    new_value = value.im_func
-                # already decorated attribute, assigned from another class
-                elif isinstance(value, sample_property) and name!= value.name:
-                    new_value = value.method
-                # classmethod, staticmethod and etc
-                else:
-                    continue
-                setattr(self, name, sample_property(new_value, name=name))
-            return self
+    def _source(self):
+        values = [(name, _function_source(value)
+                         if isinstance(value, types.FunctionType)
+                         else repr(value))
+                  for name, value in sorted(self.values.items())]
+        return repr((self.model.__name__, self.count, values))
+
+
+def _class_attribute(cls, name):
+    # raw attribute from class dictionaries, plain functions are not turned
+    # into methods on Python 3 and can't be told from staticmethods otherwise
+    for klass in cls.__mro__:
+        if name in klass.__dict__:
+            return klass.__dict__[name]
+
+
+class _SampleMeta(type):
+
+    def __new__(cls, cls_name, bases, attributes):
+        self = type.__new__(cls, cls_name, bases, attributes)
+        # names of sample properties are collected into ordered
+        # `_sample_properties` registry, only own attributes, registries
+        # of base samples and attributes of other bases (mixins) can
+        # be properties
+        names = set(attributes)
+        properties = []
+        registries = [getattr(base, '_sample_properties', None)
+                      for base in bases]
+        if len(bases) == 1 and registries[0] is not None:
+            # inherited properties are not overridden
+            properties = [name for name in registries[0]
+                          if name not in names]
+        else:
+            for base, registry in zip(bases, registries):
+                names.update(dir(base) if registry is None else registry)
+        reserved = getattr(self, '_reserved_names', ())
+        for name in names:
+            if name.startswith('_') or name == 'create_all':
+                continue
+            value = _class_attribute(self, name)
+            if name in reserved:
+                owner = [klass for klass in self.__mro__
+                         if '_reserved_names' in klass.__dict__][0]
+                if value is not _class_attribute(owner, name) and \
+                        isinstance(value, (types.FunctionType,
+                                           sample_property)):
+                    raise TypeError('%s: %s is reserved by Sample and '
+                                    'can\'t be a sample property' %
+                                    (cls_name, name))
+                continue
+            if isinstance(value, types.FunctionType):
+                new_value = value
+            # already decorated attribute, assigned from another class
+            elif isinstance(value, sample_property) and name!= value.name:
+                setattr(self, name, value._renamed(name))
+                properties.append(name)
+                continue
+            elif isinstance(value, sample_property):
+                properties.append(name)
+                continue
+            # classmethod, staticmethod and etc
+            else:
+                continue
+            setattr(self, name, sample_property(new_value, name=name))
+            properties.append(name)
+        self._sample_properties = tuple(sorted(properties))
+        return self
+
+
+class Sample(_SampleMeta('_SampleBase', (object,), {})):
+
+    # seed of `random` generators, unseeded when None
+    seed = None
+    # number of objects committed at once from generator properties
+    chunk_size = 1000
+    # attributes of sample, can't be overridden by sample properties
+    _reserved_names = frozenset([
+        'db', 'seed', 'chunk_size', 'random', 'used_properties',
+        'dependencies', 'created_idents', 'create', 'closure',
+        'create_all_async', 'create_async'])
 
     def __init__(self, db, **kwargs):
-        if isinstance(db, ScopedSession):
-            db = db.registry()
-        self.db = db
+        self.db, self._async_db = _split_session(db)
         self.used_properties = set()
+        # property name -> names of properties used by it
+        self.dependencies = {}
+        # class -> set of identities of rows inserted by the sample
+        self.created_idents = {}
+        self._resolving = []
+        self._bulk_objects = None
+        self._randoms = {}
         self.__dict__.update(kwargs)
 
-    def create_all(self):
-        if self.db.autocommit:
-            self.db.begin()
-        map(lambda name: getattr(self, name), dir(self))
-        self.db.commit()
+    def create_all(self, bulk=False):
+        # In bulk mode objects are inserted with executemany grouped by
+        # mapper instead of unit of work flush. No flush events are emitted,
+        # so use it with Restorable in `rollback` or `truncate` strategies.
+        self._create(self._sample_properties, bulk)
 
+    def create(self, *names, **kwargs):
+        '''Creates objects of given properties and properties used by them
+        only'''
+        for name in names:
+            if name not in self._sample_properties:
+                raise AttributeError('%s has no sample property %s' %
+                                     (self.__class__.__name__, name))
+        bulk = kwargs.pop('bulk', False)
+        if kwargs:
+            raise TypeError('create() got an unexpected keyword argument %r'
+                            % sorted(kwargs)[0])
+        self._create(names, bulk)
 
-class Restorable(object):
+    @property
+    def random(self):
+        '''Random numbers generator of property being created, seeded with
+        `seed` and property name, so data of a property does not depend on
+        other properties created'''
+        name = self._resolving[-1] if self._resolving else None
+        if name not in self._randoms:
+            if self.seed is None:
+                self._randoms[name] = random.Random()
+            else:
+                # str seeds are hashed with hash() on Python 2, which depends
+                # on PYTHONHASHSEED
+                digest = hashlib.sha1(('%s.%s' % (self.seed, name))
+                                      .encode('utf-8')).hexdigest()
+                self._randoms[name] = random.Random(int(digest, 16))
+        return self._randoms[name]
+
+    def create_all_async(self, bulk=False):
+        '''Awaitable `create_all` for sample created with `AsyncSession`'''
+        return _run_sync(self._async_db, self.create_all, bulk)
+
+    def create_async(self, *names, **kwargs):
+        return _run_sync(self._async_db,
+                         lambda: self.create(*names, **kwargs))
+
+    def closure(self, *names):
+        '''Names of given properties and properties they depend on, as
+        recorded in `dependencies`'''
+        result = set()
+        names = list(names)
+        while names:
+            name = names.pop()
+            if name not in result:
+                result.add(name)
+                names.extend(self.dependencies.get(name, ()))
+        return result
+
+    def _create(self, names, bulk):
+        _begin(self.db)
+        _listen(self.db, 'after_flush', self._after_flush)
+        try:
+            if bulk:
+                self._bulk_objects = []
+                try:
+                    for name in names:
+                        getattr(self, name)
+                    objects = self._bulk_objects
+                finally:
+                    self._bulk_objects = None
+                self._collect(_bulk_insert(self.db, objects))
+            else:
+                for name in names:
+                    getattr(self, name)
+            self.db.commit()
+        finally:
+            _unlisten(self.db, 'after_flush', self._after_flush)
+
+    def _after_flush(self, db, flush_context, instances=None):
+        self._collect(db.new)
+
+    def _collect(self, objects):
+        for obj in objects:
+            cls, ident = util.identity_key(instance=obj)[:2]
+            self.created_idents.setdefault(cls, set()).add(ident)
+
+    def _stream(self, objects):
+        '''Inserts objects from generator by chunks, each chunk is committed
+        and expunged from session. Returns number of objects.'''
+        if self._bulk_objects:
+            # objects of other properties can be referenced
+            self._collect(_bulk_insert(self.db, self._bulk_objects))
+            del self._bulk_objects[:]
+        count = 0
+        for chunk in _chunks(objects, self.chunk_size):
+            if self._bulk_objects is not None:
+                self._collect(_bulk_insert(self.db, chunk))
+            else:
+                self.db.add_all(chunk)
+            self.db.commit()
+            _begin(self.db)
+            for obj in chunk:
+                self.db.expunge(obj)
+            count += len(chunk)
+        return count
+
+
+def _function_source(func):
+    try:
+        return inspect.getsource(func)
+    except (IOError, TypeError):
+        return marshal.dumps(func.__code__)
+
+
+def _sqlite_copy(source_path, target):
+    '''Copies tables of SQLite database file into DBAPI connection'''
+    if hasattr(target, 'backup'):
+        # Python 3.7+
+        source = sqlite3.connect(source_path)
+        try:
+            source.backup(target)
+        finally:
+            source.close()
+        return
+    target.commit()
+    cursor = target.cursor()
+    cursor.execute('ATTACH DATABASE ? AS testalchemy_source', (source_path,))
+    try:
+        # tables, indexes, views and triggers already present are kept
+        existing = set(row[0] for row in cursor.execute(
+            "SELECT name FROM main.sqlite_master"))
+        items = cursor.execute(
+            "SELECT type, name, sql FROM testalchemy_source.sqlite_master "
+            "WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'").fetchall()
+        tables = [name for type_, name, sql in items if type_ == 'table']
+        for name in reversed(tables):
+            if name in existing:
+                cursor.execute('DELETE FROM main."%s"' % name)
+        for type_, name, sql in items:
+            if name not in existing:
+                cursor.execute(sql)
+        for name in tables:
+            cursor.execute('INSERT INTO main."%s" '
+                           'SELECT * FROM testalchemy_source."%s"' %
+                           (name, name))
+        target.commit()
+    finally:
+        cursor.execute('DETACH DATABASE testalchemy_source')
+        cursor.close()
+
+
+def _with_database(url, database):
+    url = make_url(str(url))
+    if hasattr(url, 'set'):
+        # URL is immutable since SQLAlchemy 1.4
+        return url.set(database=database)
+    url.database = database
+    return url
+
+
+def _postgresql_create(target, template=None):
+    target.dispose()
+    name = target.url.database
+    server = create_engine(_with_database(target.url, 'postgres'),
+                           isolation_level='AUTOCOMMIT')
+    try:
+        quote = server.dialect.identifier_preparer.quote
+        server.execute('DROP DATABASE IF EXISTS %s' % quote(name))
+        if template is None:
+            server.execute('CREATE DATABASE %s' % quote(name))
+        else:
+            server.execute('CREATE DATABASE %s TEMPLATE %s' % (
+                quote(name), quote(template)))
+    finally:
+        server.dispose()
+
+
+def clone_database(source, target):
+    '''Replaces content of `target` database with copy of `source` one.
+    Both arguments are engines. SQLite file can be copied to another file or
+    in-memory database, PostgreSQL database is recreated with
+    `CREATE DATABASE ... TEMPLATE`.'''
+    dialect = source.dialect.name
+    assert dialect == target.dialect.name
+    if dialect == 'sqlite':
+        assert source.url.database, 'Source SQLite database must be a file'
+        raw = target.raw_connection()
+        try:
+            _sqlite_copy(source.url.database, raw.connection)
+        finally:
+            raw.close()
+    elif dialect == 'postgresql':
+        # template database must have no connections
+        source.dispose()
+        _postgresql_create(target, source.url.database)
+    else:
+        raise NotImplementedError('Cloning of %s databases is not supported'
+                                  % dialect)
+
+
+try:
+    _BINARY_TYPES = (bytearray, memoryview, buffer)
+except NameError:
+    # Python 3
+    _BINARY_TYPES = (bytearray, memoryview, bytes)
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if isinstance(value, _BINARY_TYPES):
+        return {'base64': base64.b64encode(bytes(value)).decode('ascii')}
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+def _bind_connection(bind):
+    return _session_bind(bind)[1].connect()
+
+
+def dump_tables(bind, tables, stream, chunk_size=1000):
+    '''Writes rows of `tables` (list or `MetaData`) to `stream` as JSON
+    lines: `{"table": name, "columns": [...]}` header is followed by a list
+    of values per row. Tables are ordered by dependency, values are written
+    as returned by DBAPI driver, so no type processing is made.'''
+    if isinstance(tables, MetaData):
+        tables = tables.sorted_tables
+    _dump(bind, tables, stream, chunk_size)
+
+
+def _dump(bind, tables, stream, chunk_size, plan=None):
+    # with `plan` (table -> list of (columns, set of values)) rows matching
+    # all entries of the table are written only
+    connection = _bind_connection(bind)
+    try:
+        cursor = connection.connection.cursor()
+        try:
+            for table in sort_tables(tables):
+                columns = [c.name for c in table.columns]
+                stream.write(json.dumps({'table': table.name,
+                                         'columns': columns}) + '\n')
+                if plan is None:
+                    _dump_rows(connection, cursor, select([table]), stream,
+                               chunk_size)
+                    continue
+                # rows are selected in order by chunks of the first entry
+                # values and filtered by the rest
+                (keys, values), rest = plan[table][0], plan[table][1:]
+                filters = [([columns.index(c.name) for c in entry_columns],
+                            entry_values)
+                           for entry_columns, entry_values in rest]
+                size = max(1, MAX_PARAMS // len(keys))
+                for chunk in _chunks(sorted(values), size):
+                    statement = select([table]).where(
+                        _pk_criterion(keys, chunk)).order_by(*keys)
+                    _dump_rows(connection, cursor, statement, stream,
+                               chunk_size, filters)
+        finally:
+            cursor.close()
+    finally:
+        connection.close()
+
+
+def _dump_rows(connection, cursor, statement, stream, chunk_size,
+               filters=()):
+    compiled = statement.compile(dialect=connection.dialect, compile_kwargs={
+        'render_postcompile': True})
+    params = compiled.construct_params()
+    if compiled.positional:
+        params = [params[name] for name in compiled.positiontup]
+    cursor.execute(str(compiled), params)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        stream.write(''.join(
+            json.dumps(list(row), default=_json_default) + '\n'
+            for row in rows
+            if all(tuple(row[i] for i in positions) in values
+                   for positions, values in filters)))
+
+
+def dump_sample(sample, stream, tables=None, chunk_size=1000):
+    '''Dumps rows inserted by materialized `sample` (as recorded in
+    `created_idents`) with rows of subclass and association tables between
+    them in `dump_tables` format. Pass `tables` to dump some of them only.'''
+    plan = {}
+    for mapper, table, columns, idents in _deletion_plan(
+            sample.created_idents):
+        plan.setdefault(table, []).append((columns, idents))
+    if tables is not None:
+        if isinstance(tables, MetaData):
+            tables = tables.sorted_tables
+        plan = dict((table, plan[table]) for table in tables
+                    if table in plan)
+    _dump(sample.db, list(plan), stream, chunk_size, plan)
+
+
+def load_tables(bind, stream, chunk_size=1000):
+    '''Loads rows written by `dump_tables` with executemany statements of
+    `chunk_size` rows, reading the stream line by line. No ORM objects are
+    created and no type processing is made.'''
+    connection = _bind_connection(bind)
+    try:
+        with connection.begin():
+            Binary = connection.dialect.dbapi.Binary
+            def decode(value):
+                if isinstance(value, dict):
+                    return Binary(base64.b64decode(value['base64']))
+                return value
+            statement = columns = None
+            rows = []
+            loaded = []
+            for line in stream:
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                if isinstance(item, dict):
+                    if rows:
+                        connection.execute(statement, rows)
+                        rows = []
+                    columns = item['columns']
+                    loaded.append((item['table'], columns))
+                    statement = table_clause(item['table'], *[
+                        column_clause(name) for name in columns]).insert()
+                    continue
+                rows.append(dict(zip(columns, map(decode, item))))
+                if len(rows) >= chunk_size:
+                    connection.execute(statement, rows)
+                    rows = []
+            if rows:
+                connection.execute(statement, rows)
+            if connection.dialect.name == 'postgresql':
+                for name, columns in loaded:
+                    _reset_sequences(connection, name, columns)
+    finally:
+        connection.close()
+
+
+def _reset_sequences(connection, name, columns):
+    # explicitly inserted keys are not taken from serial sequences, so they
+    # are moved past maximal values
+    quoted = connection.dialect.identifier_preparer.quote(name)
+    sequences = connection.execute(select([
+        func.pg_get_serial_sequence(quoted, column) for column in columns
+    ])).first()
+    for column, sequence in zip(columns, sequences):
+        if sequence is not None:
+            connection.execute(select([func.setval(
+                sequence, select([func.max(column_clause(column))])
+                .select_from(table_clause(name)).as_scalar())]))
+
+
+class _FileLock(object):
+    '''Lock shared between processes, held while the file exists. The
+    holder touches the file every `timeout` / 4 seconds, so lock file older
+    than `timeout` seconds is left by crashed process and is removed.'''
+
+    def __init__(self, path, timeout=600, interval=0.05):
+        self.path = path
+        self.timeout = timeout
+        self.interval = interval
+
+    def __enter__(self):
+        while True:
+            try:
+                os.close(os.open(self.path,
+                                 os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                self._released = threading.Event()
+                self._heartbeat = threading.Thread(target=self._touch)
+                self._heartbeat.daemon = True
+                self._heartbeat.start()
+                return self
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+                try:
+                    if time.time() - os.path.getmtime(self.path) > \
+                            self.timeout:
+                        os.remove(self.path)
+                        continue
+                except OSError:
+                    # released meanwhile
+                    continue
+                time.sleep(self.interval)
+
+    def __exit__(self, type, value, traceback):
+        self._released.set()
+        self._heartbeat.join()
+        os.remove(self.path)
+
+    def _touch(self):
+        while not self._released.wait(self.timeout / 4.0):
+            try:
+                os.utime(self.path, None)
+            except OSError:
+                pass
+
+
+class SampleCache(object):
+    '''Materializes `Sample` subclass once into a template database and
+    copies the template for every test. Cache key includes source of sample
+    methods, schema and keyword arguments of the sample, so changed samples
+    are materialized again.'''
+
+    # changed when format of cached files changes
+    FORMAT = '2'
+
+    def __init__(self, metadata, directory=None):
+        self.metadata = metadata
+        self.directory = directory or os.path.join(tempfile.gettempdir(),
+                                                   'testalchemy')
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def key(self, sample_cls, dialect, **kwargs):
+        digest = hashlib.sha1()
+        def update(data):
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            digest.update(data)
+        update(self.FORMAT)
+        for cls in sample_cls.__mro__:
+            if cls in Sample.__mro__:
+                continue
+            update(cls.__name__)
+            for name, value in sorted(cls.__dict__.items()):
+                if isinstance(value, batch):
+                    update(name)
+                    update(value._source())
+                    continue
+                if isinstance(value, sample_property):
+                    value = value.method
+                if isinstance(value, types.FunctionType):
+                    update(name)
+                    update(_function_source(value))
+        for table in self.metadata.sorted_tables:
+            update(str(CreateTable(table).compile(dialect=dialect)))
+        update(repr(sorted(kwargs.items())))
+        return digest.hexdigest()
 
-    def __init__(self, db, watch=None):
+    def create(self, sample_cls, db, **kwargs):
+        '''Fills database of `db` session with sample data and returns sample
+        instance with all properties loaded from the database.'''
         if isinstance(db, ScopedSession):
             db = db.registry()
-        self.db = db
-        self.watch = watch or db
+        target = db.get_bind()
+        key = self.key(sample_cls, target.dialect, **kwargs)
+        template = self._template_engine(target, key)
+        properties_path = os.path.join(self.directory, key + '.pickle')
+        def ready():
+            return os.path.exists(properties_path) and not (
+                template.dialect.name == 'sqlite' and
+                not os.path.exists(template.url.database))
+        try:
+            if not ready():
+                # parallel workers materialize the template once
+                with _FileLock(os.path.join(self.directory, key + '.lock')):
+                    if not ready():
+                        self._materialize(sample_cls, template,
+                                          properties_path, kwargs)
+            db.close()
+            clone_database(template, target)
+        finally:
+            template.dispose()
+        with open(properties_path, 'rb') as f:
+            properties, created_idents = pickle.load(f)
+        sample = sample_cls(db, **kwargs)
+        sample.created_idents = created_idents
+        return self._load(sample, properties)
+
+    def _template_engine(self, target, key):
+        url = target.url
+        if url.drivername.startswith('sqlite'):
+            url = _with_database(url, os.path.join(self.directory,
+                                                   key + '.sqlite'))
+        else:
+            url = _with_database(url, '%s_%s' % (url.database, key[:16]))
+        return create_engine(url)
+
+    def _materialize(self, sample_cls, template, properties_path, kwargs):
+        if template.dialect.name == 'postgresql':
+            _postgresql_create(template)
+        elif os.path.exists(template.url.database):
+            os.remove(template.url.database)
+        self.metadata.create_all(template)
+        db = Session(bind=template)
+        try:
+            sample = sample_cls(db, **kwargs)
+            sample.create_all()
+            properties = {}
+            for name in sample.used_properties:
+                value = getattr(sample, name)
+                # number of rows created by batch or generator properties
+                if isinstance(value, numbers.Integral):
+                    properties[name] = (int, value)
+                elif isinstance(value, (list, tuple)):
+                    keys = [util.identity_key(instance=obj)[:2]
+                            for obj in value]
+                    properties[name] = (type(value), keys)
+                else:
+                    properties[name] = (None,
+                                        util.identity_key(instance=value)[:2])
+            created_idents = sample.created_idents
+        finally:
+            db.close()
+        template.dispose()
+        # written last, so existence of this file marks ready template
+        tmp_path = '%s.%d' % (properties_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((properties, created_idents), f,
+                        pickle.HIGHEST_PROTOCOL)
+        shutil.move(tmp_path, properties_path)
+
+    def _load(self, sample, properties):
+        idents = {}
+        for container, keys in properties.values():
+            if container is int:
+                continue
+            for cls, ident in keys if container else [keys]:
+                idents.setdefault(cls, set()).add(ident)
+        # keeps loaded instances in (weak referencing) identity map
+        loaded = [_load_idents(sample.db, cls, cls_idents)
+                  for cls, cls_idents in idents.items()]
+        identity_map = sample.db.identity_map
+        def get(key):
+            return identity_map.get(util.identity_key(*key))
+        for name, (container, keys) in properties.items():
+            if container is int:
+                value = keys
+            elif container:
+                value = container(get(key) for key in keys)
+            else:
+                value = get(keys)
+            setattr(sample, name, value)
+            sample.used_properties.add(name)
+        del loaded
+        return sample
+
+
+def worker_id():
+    '''Name of current parallel worker: pytest-xdist worker id or process
+    id for other runners'''
+    return os.environ.get('PYTEST_XDIST_WORKER') or 'pid%d' % os.getpid()
+
+
+class DatabasePool(object):
+    '''Provides isolated database for every parallel worker, cloned from
+    prepared `template` engine on first use. `url` of worker databases may
+    contain `{worker}` placeholder, by default worker id is appended to the
+    name of template database. `sqlite://` URL gives in-memory database per
+    worker.'''
+
+    def __init__(self, template, url=None, retries=5):
+        self.template = template
+        self.url = url or self._default_url()
+        self.retries = retries
+        self.engines = {}
+
+    def _default_url(self):
+        url = self.template.url
+        if url.drivername.startswith('sqlite'):
+            root, ext = os.path.splitext(url.database)
+            url = _with_database(url, root + '_{worker}' + ext)
+        else:
+            url = _with_database(url, url.database + '_{worker}')
+        return str(url)
+
+    def engine(self):
+        '''Engine of current worker database'''
+        worker = worker_id()
+        if worker not in self.engines:
+            self.engines[worker] = self._provision(worker)
+        return self.engines[worker]
+
+    def session(self, **kwargs):
+        '''New session bound to current worker database'''
+        return Session(bind=self.engine(), **kwargs)
+
+    def reset(self):
+        '''Replaces current worker database with fresh copy of template'''
+        self._clone(self.engine())
+
+    def dispose(self):
+        '''Disposes engines of worker databases created by this process,
+        files of SQLite databases are removed'''
+        for engine in self.engines.values():
+            engine.dispose()
+            if engine.dialect.name == 'sqlite' and engine.url.database and \
+                    os.path.exists(engine.url.database):
+                os.remove(engine.url.database)
+        self.engines.clear()
+
+    def _provision(self, worker):
+        url = make_url(self.url.format(worker=worker))
+        if url.drivername.startswith('sqlite') and not _in_memory(url) and \
+                os.path.exists(url.database):
+            os.remove(url.database)
+        engine = _make_engine(url)
+        self._clone(engine)
+        return engine
+
+    def _clone(self, engine):
+        for attempt in range(self.retries):
+            try:
+                clone_database(self.template, engine)
+                return
+            except exc.OperationalError:
+                # PostgreSQL template is being copied by another worker
+                if engine.dialect.name != 'postgresql' or \
+                        attempt == self.retries - 1:
+                    raise
+                time.sleep(0.1 * (attempt + 1))
+
+
+class SharedDatabase(object):
+    '''Engine and schema of `metadata` created once per process. Every
+    `with shared_database as session:` block gets new session on long-lived
+    connection, changes are reverted with `Restorable` of given `strategy`
+    on exit.'''
+
+    def __init__(self, metadata, url='sqlite://', strategy='rollback',
+                 **session_kwargs):
+        self.metadata = metadata
+        self.url = url
+        self.strategy = strategy
+        self.session_kwargs = session_kwargs
+        self._engine = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def engine(self):
+        # forked workers create their own engine and schema
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._engine = self._create_engine()
+                    self.metadata.create_all(self._engine)
+                    self._pid = os.getpid()
+        return self._engine
+
+    def _create_engine(self):
+        url = make_url(self.url)
+        engine = _make_engine(url)
+        if not url.drivername.startswith('sqlite'):
+            return engine
+        # pysqlite doesn't handle SAVEPOINT used by `rollback` strategy
+        @event.listens_for(engine, 'connect')
+        def connect(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+        @event.listens_for(engine, 'begin')
+        def begin(connection):
+            connection.execute('BEGIN')
+        return engine
+
+    def __enter__(self):
+        self.db = Session(bind=self.engine, **self.session_kwargs)
+        self.restorable = Restorable(self.db, strategy=self.strategy)
+        self.restorable.__enter__()
+        return self.db
+
+    def __exit__(self, type, value, traceback):
+        try:
+            self.restorable.__exit__(type, value, traceback)
+        finally:
+            self.db.close()
+            del self.db, self.restorable
+
+    def isolate(self, testcase):
+        '''Enters the context for `unittest.TestCase` until its cleanup and
+        returns session'''
+        session = self.__enter__()
+        testcase.addCleanup(self.__exit__, None, None, None)
+        return session
+
+    def dispose(self):
+        if self._engine is not None:
+            self._engine.dispose()
+        self._engine = self._pid = None
+
+
+class Restorable(object):
+
+    def __init__(self, db, watch=None, max_params=MAX_PARAMS,
+                 strategy='delete'):
+        assert strategy in ('delete', 'undo', 'rollback', 'truncate')
+        # several sessions are supported by `delete` strategy
+        sessions = db if isinstance(db, (list, tuple)) else [db]
+        assert len(sessions) == 1 or strategy == 'delete'
+        self.sessions = [_split_session(session)[0] for session in sessions]
+        self.db, self._async_db = _split_session(sessions[0])
+        if watch is not None and not isinstance(watch, ScopedSession):
+            # session classes and factories are watched as is
+            watch = _split_session(watch)[0]
+        self.watch = watch or self.db
+        self._watched = [watch] if watch is not None else self.sessions
+        self.max_params = max_params
+        self.strategy = strategy
         self.history = {}
+        # bind -> class -> identities
+        self.bind_history = {}
+        self.dirty_tables = set()
+        self.undo_log = []
 
     def __enter__(self):
-        event.listen(self.watch, 'after_flush', self.after_flush)
+        getattr(self, '_enter_%s' % self.strategy)()
 
     def __exit__(self, type, value, traceback):
+        getattr(self, '_exit_%s' % self.strategy)()
+
+    def __aenter__(self):
+        return _run_sync(self._async_db, self.__enter__)
+
+    def __aexit__(self, type, value, traceback):
+        return _run_sync(self._async_db, self.__exit__, type, value,
+                         traceback)
+
+    def _enter_delete(self):
+        for target in self._watched:
+            _listen(target, 'after_flush', self.after_flush)
+
+    def _exit_delete(self):
+        if len(self.sessions) > 1 or len(self.bind_history) > 1:
+            for db in self.sessions:
+                db.rollback()
+                db.close()
+            self._delete_by_binds()
+        else:
+            db = self.db
+            db.rollback()
+            db.expunge_all()
+            old_autoflush = db.autoflush
+            db.autoflush = False
+            _begin(db)
+            self._delete_created(db, self.history)
+            db.commit()
+            db.close()
+            db.autoflush = old_autoflush
+        for target in self._watched:
+            _unlisten(target, 'after_flush', self.after_flush)
+
+    def _deletion_statements(self, history):
+        for mapper, table, columns, idents in _deletion_plan(history):
+            size = max(1, self.max_params // len(columns))
+            for chunk in _chunks(idents, size):
+                yield mapper, table.delete(_pk_criterion(columns, chunk))
+
+    def _delete_created(self, db, history):
+        for mapper, statement in self._deletion_statements(history):
+            db.execute(statement, mapper=mapper)
+
+    def _delete_from_bind(self, item):
+        bind, history = item
+        connection = bind.connect()
+        try:
+            transaction = connection.begin()
+            for mapper, statement in self._deletion_statements(history):
+                connection.execute(statement)
+            transaction.commit()
+        finally:
+            connection.close()
+
+    def _delete_by_binds(self):
+        # each database is cleaned in own thread, so the slowest one
+        # determines the time
+        items = self.bind_history.items()
+        if len(items) > 1 and all(_thread_safe(bind) for bind, h in items):
+            pool = ThreadPool(len(items))
+            try:
+                pool.map(self._delete_from_bind, items)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for item in items:
+                self._delete_from_bind(item)
+
+    def _enter_undo(self):
+        # Every committed flush adds (created, updated, deleted) entry to
+        # `undo_log`, where `updated` holds original values of changed
+        # columns and `deleted` holds full rows, both read before the flush.
+        # Changes of many-to-many association rows are not restored.
+        self._pending = []
+        _listen(self.watch, 'before_flush', self._log_changes)
+        _listen(self.watch, 'after_flush', self._log_created)
+        _listen(self.watch, 'after_commit', self._commit_log)
+        _listen(self.watch, 'after_soft_rollback', self._rollback_log)
+
+    def _exit_undo(self):
+        _unlisten(self.watch, 'before_flush', self._log_changes)
+        _unlisten(self.watch, 'after_flush', self._log_created)
+        _unlisten(self.watch, 'after_commit', self._commit_log)
+        _unlisten(self.watch, 'after_soft_rollback', self._rollback_log)
         db = self.db
         db.rollback()
         db.expunge_all()
         old_autoflush = db.autoflush
         db.autoflush = False
-        if db.autocommit:
-            db.begin()
-        for cls, ident_set in self.history.items():
-            for ident in ident_set:
-                instance = db.query(cls).get(ident)
-                if instance is not None:
-                    db.delete(instance)
+        _begin(db)
+        for created, updated, deleted in reversed(self.undo_log):
+            for table in sort_tables(deleted):
+                mapper, rows = deleted[table]
+                db.execute(table.insert(), list(rows.values()),
+                           mapper=mapper)
+            for table, (mapper, rows) in updated.items():
+                self._restore_columns(db, mapper, table, rows)
+            self._delete_created(db, created)
         db.commit()
         db.close()
         db.autoflush = old_autoflush
-        remove_event(self.watch, 'after_flush', self.after_flush)
-        
+
+    def _restore_columns(self, db, mapper, table, rows):
+        pk_columns = list(table.primary_key.columns)
+        groups = {}
+        for pk, values in rows.items():
+            groups.setdefault(frozenset(values), []).append((pk, values))
+        for columns, group in groups.items():
+            columns = list(columns)
+            criterion = and_(*[column == bindparam('pk_%d' % i)
+                               for i, column in enumerate(pk_columns)])
+            stmt = table.update().where(criterion).values(
+                dict((table.c[key], bindparam('value_%d' % i))
+                     for i, key in enumerate(columns)))
+            params = []
+            for pk, values in group:
+                param = dict(('pk_%d' % i, value)
+                             for i, value in enumerate(pk))
+                param.update(('value_%d' % i, values[key])
+                             for i, key in enumerate(columns))
+                params.append(param)
+            db.execute(stmt, params, mapper=mapper)
+
+    def _is_created(self, state):
+        return state.key is None or \
+                state.key[1] in self.history.get(state.key[0], ())
+
+    def _log_changes(self, db, flush_context, instances=None):
+        updated = {}
+        deleted = {}
+        to_load = {}
+        def log_columns(state, columns):
+            if self._is_created(state):
+                return
+            mapper = state.mapper
+            for column in columns:
+                table = column.table
+                pk = _row_pk(mapper, table, state.key[1])
+                values = updated.setdefault(table, (mapper, {}))[1]\
+                        .setdefault(pk, {})
+                if column.key in values:
+                    continue
+                prop = mapper.get_property_by_column(column)
+                history = attributes.get_history(
+                    state.obj(), prop.key,
+                    passive=attributes.PASSIVE_NO_INITIALIZE)
+                if history.deleted:
+                    values[column.key] = history.deleted[0]
+                elif history.unchanged:
+                    values[column.key] = history.unchanged[0]
+                else:
+                    to_load.setdefault((mapper, table), {})\
+                            .setdefault(pk, set()).add(column)
+        for obj in db.dirty:
+            state = attributes.instance_state(obj)
+            mapper = state.mapper
+            columns = set()
+            for prop in mapper.iterate_properties:
+                history = attributes.get_history(
+                    obj, prop.key, passive=attributes.PASSIVE_NO_INITIALIZE)
+                if not history.has_changes():
+                    continue
+                if isinstance(prop, ColumnProperty):
+                    columns.update(c for c in prop.columns
+                                   if c.table in mapper.tables)
+                elif isinstance(prop, RelationshipProperty):
+                    # foreign keys are synchronized during flush
+                    if prop.direction is MANYTOONE:
+                        columns.update(prop.local_columns)
+                    elif prop.direction is ONETOMANY:
+                        children = list(history.added) + \
+                                list(history.deleted)
+                        for child in children:
+                            child_state = attributes.instance_state(child)
+                            log_columns(child_state, [
+                                c for c in prop.remote_side
+                                if c.table in child_state.mapper.tables])
+            log_columns(state, columns)
+        for obj in db.deleted:
+            state = attributes.instance_state(obj)
+            if self._is_created(state):
+                continue
+            for table in state.mapper.tables:
+                pk = _row_pk(state.mapper, table, state.key[1])
+                to_load.setdefault((state.mapper, table), {})[pk] = None
+        for (mapper, table), rows in to_load.items():
+            pk_columns = list(table.primary_key.columns)
+            size = max(1, self.max_params // len(pk_columns))
+            for chunk in _chunks(rows, size):
+                stmt = select([table]).where(_pk_criterion(pk_columns, chunk))
+                for row in db.execute(stmt, mapper=mapper):
+                    row = dict((c.key, row[c]) for c in table.c)
+                    pk = tuple(row[c.key] for c in pk_columns)
+                    columns = rows[pk]
+                    if columns is None:
+                        deleted.setdefault(table, (mapper, {}))[1][pk] = row
+                        # values changed before deletion are restored too
+                        if table in updated:
+                            updated[table][1].pop(pk, None)
+                    else:
+                        values = updated[table][1][pk]
+                        for column in columns:
+                            values[column.key] = row[column.key]
+        self._pending.append(({}, updated, deleted))
+
+    def _log_created(self, db, flush_context, instances=None):
+        created = self._pending[-1][0]
+        for instance in db.new:
+            cls, ident = util.identity_key(instance=instance)[:2]
+            created.setdefault(cls, set()).add(ident)
+            self.history.setdefault(cls, set()).add(ident)
+
+    def _commit_log(self, db):
+        if db.transaction.nested:
+            return
+        self.undo_log.extend(self._pending)
+        self._pending = []
+
+    def _rollback_log(self, db, previous_transaction):
+        self._pending = []
+
+    def _enter_rollback(self):
+        # Session works on a connection inside of the outer transaction,
+        # which is rolled back on exit. Session transactions are turned to
+        # savepoints, so `commit` and `rollback` made by the code under test
+        # behave as usual.
+        db = self.db
+        db.close()
+        self._old_bind = db.bind
+        self.connection = db.get_bind().connect()
+        if self.connection.dialect.driver == 'pysqlite' and \
+                self.connection.connection.isolation_level is not None:
+            # pysqlite commits on its own and loses savepoints
+            self.connection.close()
+            raise RuntimeError(
+                'pysqlite needs SAVEPOINT workaround for rollback strategy: '
+                'set isolation_level of DBAPI connection to None on '
+                '"connect" event and emit BEGIN on "begin" event')
+        self.transaction = self.connection.begin()
+        self.savepoint = self.connection.begin_nested()
+        db.bind = self.connection
+        _listen(db, 'after_transaction_end', self._restart_savepoint)
+
+    def _exit_rollback(self):
+        db = self.db
+        _unlisten(db, 'after_transaction_end', self._restart_savepoint)
+        db.close()
+        self.transaction.rollback()
+        self.connection.close()
+        db.bind = self._old_bind
+
+    def _restart_savepoint(self, db, transaction):
+        if transaction._parent is not None:
+            return
+        if self.savepoint.is_active:
+            self.savepoint.commit()
+        self.savepoint = self.connection.begin_nested()
+
+    def _enter_truncate(self):
+        # Only written tables are recorded, all rows of them are removed on
+        # exit. Flushes are tracked per mapper, other statements (including
+        # many-to-many association rows) are caught at the engine level.
+        self._mappers = set()
+        self._dirty_names = set()
+        self._engine = self.db.get_bind()
+        _listen(self.watch, 'after_flush', self._record_mappers)
+        _listen(self._engine, 'after_cursor_execute', self._record_table)
+
+    def _exit_truncate(self):
+        _unlisten(self.watch, 'after_flush', self._record_mappers)
+        _unlisten(self._engine, 'after_cursor_execute', self._record_table)
+        db = self.db
+        db.rollback()
+        db.expunge_all()
+        _begin(db)
+        for mapper in self._mappers:
+            self.dirty_tables.update(mapper.tables)
+        unknown = self._resolve_names()
+        tables = sort_tables(self.dirty_tables)
+        dialect = self._engine.dialect
+        if (tables or unknown) and dialect.name == 'postgresql':
+            # tables referenced by foreign keys must be truncated at once
+            preparer = dialect.identifier_preparer
+            names = ', '.join([preparer.format_table(t) for t in tables] +
+                              [preparer.quote(t.name) for t in unknown])
+            db.execute('TRUNCATE %s' % names, bind=self._engine)
+        else:
+            # order of tables without metadata is unknown, they are supposed
+            # to be referenced by nothing
+            for table in unknown + list(reversed(tables)):
+                db.execute(table.delete(), bind=self._engine)
+        db.commit()
+        db.close()
+
+    def _record_mappers(self, db, flush_context, instances=None):
+        for instances in (db.new, db.dirty, db.deleted):
+            for instance in instances:
+                self._mappers.add(object_mapper(instance))
+
+    def _record_table(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        compiled = getattr(context, 'compiled', None)
+        if compiled is not None and \
+                (context.isinsert or context.isupdate or context.isdelete):
+            self.dirty_tables.add(compiled.statement.table)
+            return
+        # textual SQL
+        match = _DML_TABLE_RE.match(statement)
+        if match is not None:
+            self._dirty_names.add(match.group(1))
+
+    def _resolve_names(self):
+        '''Adds tables written by textual SQL to `dirty_tables`, looking
+        them up in metadata of known tables. Returns list of table clauses
+        for names not found there.'''
+        metadatas = set(table.metadata for table in self.dirty_tables)
+        names = set(table.name for table in self.dirty_tables)
+        unknown = []
+        for name in sorted(self._dirty_names - names):
+            for metadata in metadatas:
+                if name in metadata.tables:
+                    self.dirty_tables.add(metadata.tables[name])
+                    break
+            else:
+                unknown.append(table_clause(name))
+        return unknown
 
     def after_flush(self, db, flush_context, instances=None):
+        binds = {}
         for instance in db.new:
-            cls, ident = util.identity_key(instance=instance)
+            cls, ident = util.identity_key(instance=instance)[:2]
             self.history.setdefault(cls, set()).add(ident)
+            if cls not in binds:
+                bind = db.get_bind(class_mapper(cls))
+                binds[cls] = self.bind_history.setdefault(bind, {})\
+                        .setdefault(cls, set())
+            binds[cls].add(ident)
 
 
 class DBHistory(object):
 
-    def __init__(self, session):
-        assert isinstance(session, (Session, ScopedSession))
-        self.session = session
-        #XXX: It is not clear do we need events on class or object
+    def __init__(self, session, models=None, keep=None, callback=None,
+                 track_fields=False):
+        session, self._async_session = _split_session(session)
+        # Session class or sessionmaker: changes made by all their sessions
+        # in all threads are tracked
+        self.process_wide = isinstance(session, sessionmaker) or \
+                isinstance(session, type) and issubclass(session, Session)
+        assert self.process_wide or \
+                isinstance(session, (Session, ScopedSession))
+        self.session = None if self.process_wide else session
+        self._factory = session if self.process_wide else None
+        # `models` is a list of tracked classes (subclasses are tracked too)
+        # or a predicate accepting class
+        if isinstance(models, (list, tuple, set, frozenset, type)):
+            classes = tuple(models) if not isinstance(models, type) \
+                    else (models,)
+            models = lambda cls: issubclass(cls, classes)
+        self.models = models
+        self._tracked = {}
+        # With `keep` only last `keep` identities per class are kept (none
+        # for 0), so memory is bounded, and `counters` count changes per
+        # transaction.
+        # `callback` gets dict of committed identities by mode and class and
+        # changed fields by class under 'fields' key, e.g. `queue.put`.
+        self.keep = keep
+        self.callback = callback
+        self.counters = {'created': {}, 'updated': {}, 'deleted': {}}
+        # With `track_fields` old and new values of changed column attributes
+        # of updated objects are captured at flush time
+        self.track_fields = track_fields
         self._target = session
         if isinstance(session, ScopedSession):
             self._target = session.registry()
-        self._created = set()
-        self._deleted = set()
-        self._updated = set()
+        # changes flushed but not committed yet are kept per session,
+        # committed ones are merged under the lock
+        self._pending = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
         self.created_idents = {}
         self.updated_idents = {}
         self.deleted_idents = {}
+        # class -> identity -> attribute name -> (old value, new value)
+        self.updated_fields = {}
 
     def last(self, model_cls, mode):
         assert mode in ('created', 'updated', 'deleted')
-        return getattr(self, '%s_idents' % mode).get(model_cls, set())
+        idents = getattr(self, '%s_idents' % mode).get(model_cls, set())
+        return idents if self.keep is None else set(idents)
 
     def _idents_to_objects_set(self, idents, model_cls):
-        q = self.session.query
-        return set([
-            q(model_cls).get(ident) for ident in idents
-        ])
+        if self.session is not None:
+            return _load_idents(self.session, model_cls, idents)
+        # objects are loaded by short-lived session in process wide mode and
+        # returned detached
+        session = self._factory()
+        try:
+            return _load_idents(session, model_cls, idents)
+        finally:
+            session.close()
 
     def last_created(self, model_cls):
         return self._idents_to_objects_set(
@@ -157,7 +1825,7 @@ class DBHistory(object):
     def assert_(self, model_cls, ident=None, mode='created'):
         idents = self.last(model_cls, mode)
         error_msg = 'No instances of %s were %s' % (model_cls, mode)
-        assert idents, error_msg
+        assert self.count_changes(model_cls, mode), error_msg
         if ident is not None:
             i = ident if isinstance(ident, (tuple, list)) else (ident,)
             assert i in idents,'No insatances of %s with identity %r were %s' % \
@@ -170,15 +1838,85 @@ class DBHistory(object):
             model_cls
         )
 
-    def assert_updated(self, model_cls, ident=None):
-        return self._idents_to_objects_set(
-            self.assert_(model_cls, ident, 'updated'),
-            model_cls
-        )
+    def assert_updated(self, model_cls, ident=None, fields=None):
+        '''With `fields` (names of attributes or dict of their new values)
+        checks that the object (any updated object when `ident` is None) has
+        these attributes changed. Requires `track_fields`.'''
+        idents = self.assert_(model_cls, ident, 'updated')
+        if fields is not None:
+            assert self.track_fields, 'Fields are not tracked'
+            self._assert_fields(model_cls, ident, fields)
+        return self._idents_to_objects_set(idents, model_cls)
+
+    def _assert_fields(self, model_cls, ident, fields):
+        changes = self.updated_fields.get(model_cls, {})
+        if ident is not None:
+            ident = ident if isinstance(ident, (tuple, list)) else (ident,)
+            candidates = [changes.get(tuple(ident), {})]
+        else:
+            candidates = changes.values()
+        for changed in candidates:
+            if isinstance(fields, dict):
+                if all(name in changed and changed[name][1] == value
+                       for name, value in fields.items()):
+                    return
+            elif set(fields) <= set(changed):
+                return
+        raise AssertionError('No instances of %s%s were updated with %r, '
+                             'changes: %r' % (
+                                 model_cls,
+                                 '' if ident is None else ' %r' % (ident,),
+                                 fields, candidates))
 
     def assert_deleted(self, model_cls, ident=None):
         return self.assert_(model_cls, ident, 'deleted')
 
+    def count(self, model_cls, mode):
+        '''Number of changed objects'''
+        if self.keep is not None:
+            raise ValueError('Identities are not kept with `keep`, use '
+                             'count_changes()')
+        return len(self.last(model_cls, mode))
+
+    def count_changes(self, model_cls, mode):
+        '''Number of objects changed per transaction, object changed in
+        several transactions is counted several times'''
+        assert mode in ('created', 'updated', 'deleted')
+        return self.counters[mode].get(model_cls, 0)
+
+    def count_created(self, model_cls):
+        return self.count(model_cls, 'created')
+
+    def count_updated(self, model_cls):
+        return self.count(model_cls, 'updated')
+
+    def count_deleted(self, model_cls):
+        return self.count(model_cls, 'deleted')
+
+    def assert_count(self, model_cls, count, mode):
+        actual = self.count(model_cls, mode)
+        if actual != count:
+            raise AssertionError('%d instance(s) of %s %s, '
+                                 'expected %d' % (actual, model_cls, mode,
+                                                  count))
+        return actual
+
+    def assert_created_count(self, model_cls, count):
+        return self.assert_count(model_cls, count, 'created')
+
+    def assert_updated_count(self, model_cls, count):
+        return self.assert_count(model_cls, count, 'updated')
+
+    def assert_deleted_count(self, model_cls, count):
+        return self.assert_count(model_cls, count, 'deleted')
+
+    def assert_changes_count(self, model_cls, count, mode):
+        actual = self.count_changes(model_cls, mode)
+        if actual != count:
+            raise AssertionError('%d change(s) of %s %s, expected %d' %
+                                 (actual, model_cls, mode, count))
+        return actual
+
     def assert_one(self, dataset, model_cls, mode):
         if len(dataset) != 1:
             raise AssertionError('%d instance(s) of %s %s, '
@@ -199,6 +1937,31 @@ class DBHistory(object):
         result = self.assert_updated(model_cls)
         return self.assert_one(result, model_cls, 'updated')
 
+    # objects are loaded by sync session, so with `AsyncSession` they are
+    # loaded by awaitable variants in its greenlet
+
+    def last_created_async(self, model_cls):
+        return _run_sync(self._async_session, self.last_created, model_cls)
+
+    def last_updated_async(self, model_cls):
+        return _run_sync(self._async_session, self.last_updated, model_cls)
+
+    def assert_created_async(self, model_cls, ident=None):
+        return _run_sync(self._async_session, self.assert_created,
+                         model_cls, ident)
+
+    def assert_updated_async(self, model_cls, ident=None, fields=None):
+        return _run_sync(self._async_session, self.assert_updated,
+                         model_cls, ident, fields)
+
+    def assert_created_one_async(self, model_cls):
+        return _run_sync(self._async_session, self.assert_created_one,
+                         model_cls)
+
+    def assert_updated_one_async(self, model_cls):
+        return _run_sync(self._async_session, self.assert_updated_one,
+                         model_cls)
+
     def assert_nothing_happened(self):
         assert not self.created_idents, 'Something is created'
         assert not self.updated_idents, 'Something is updated'
@@ -208,49 +1971,446 @@ class DBHistory(object):
         self.created_idents = {}
         self.updated_idents = {}
         self.deleted_idents = {}
+        self.updated_fields = {}
+        self.counters = {'created': {}, 'updated': {}, 'deleted': {}}
         self.clear_cache()
 
     def clear_cache(self):
-        self._created = set()
-        self._updated = set()
-        self._deleted = set()
+        with self._lock:
+            self._pending.clear()
+
+    def _pending_changes(self, db):
+        changes = self._pending.get(db)
+        if changes is None:
+            changes = {'created': {}, 'updated': {}, 'deleted': {},
+                       'fields': {}}
+            with self._lock:
+                self._pending[db] = changes
+        return changes
 
     def __enter__(self):
-        event.listen(self._target, 'after_flush', self._after_flush)
-        event.listen(self._target, 'after_commit', self._after_commit)
-        event.listen(self._target, 'after_soft_rollback',
-                     self._after_rollback)
+        _listen(self._target, 'after_flush', self._after_flush)
+        _listen(self._target, 'after_commit', self._after_commit)
+        _listen(self._target, 'after_soft_rollback', self._after_rollback)
         self.clear_cache()
         return self
 
     def __exit__(self, type, value, traceback):
-        remove_event(self._target, 'after_flush', self._after_flush)
-        remove_event(self._target, 'after_commit', self._after_commit)
-        remove_event(self._target, 'after_soft_rollback',
-                     self._after_rollback)
+        _unlisten(self._target, 'after_flush', self._after_flush)
+        _unlisten(self._target, 'after_commit', self._after_commit)
+        _unlisten(self._target, 'after_soft_rollback', self._after_rollback)
         self.clear_cache()
 
+    def __aenter__(self):
+        return _run_sync(self._async_session, self.__enter__)
+
+    def __aexit__(self, type, value, traceback):
+        return _run_sync(self._async_session, self.__exit__, type, value,
+                         traceback)
+
     def _populate_idents_dict(self, idents, objects):
+        # `objects` are identities grouped by class, instances are not kept
+        # between flush and commit
+        for cls, cls_idents in objects.items():
+            if self.keep is not None:
+                ring = idents.setdefault(cls, OrderedDict())
+                for ident in cls_idents:
+                    ring.pop(ident, None)
+                    ring[ident] = True
+                while len(ring) > self.keep:
+                    ring.popitem(last=False)
+            elif cls in idents:
+                idents[cls].update(cls_idents)
+            else:
+                idents[cls] = set(cls_idents)
+
+    def _is_tracked(self, cls):
+        tracked = self._tracked.get(cls)
+        if tracked is None:
+            tracked = self._tracked[cls] = bool(self.models(cls))
+        return tracked
+
+    def _collect_idents(self, idents, objects):
+        filtered = self.models is not None
         for obj in objects:
+            if filtered and not self._is_tracked(obj.__class__):
+                continue
             ident = util.identity_key(instance=obj)
-            idents.setdefault(ident[0], set()).add(ident[1])
+            if ident[0] in idents:
+                idents[ident[0]].add(ident[1])
+            else:
+                idents[ident[0]] = set([ident[1]])
+
+    def _collect_fields(self, fields, objects):
+        # attribute history is still available in `after_flush`
+        filtered = self.models is not None
+        for obj in objects:
+            if filtered and not self._is_tracked(obj.__class__):
+                continue
+            cls, ident = util.identity_key(instance=obj)[:2]
+            changes = None
+            for prop in object_mapper(obj).column_attrs:
+                history = attributes.get_history(
+                    obj, prop.key, passive=attributes.PASSIVE_NO_INITIALIZE)
+                if not history.added:
+                    continue
+                if changes is None:
+                    changes = fields.setdefault(cls, {})\
+                            .setdefault(ident, {})
+                # old value is None when it was not loaded
+                old = history.deleted[0] if history.deleted else None
+                if prop.key in changes:
+                    old = changes[prop.key][0]
+                changes[prop.key] = (old, history.added[0])
 
     def _after_flush(self, db, flush_context, instances=None):
-        def identityset_to_set(obj):
-            return set(obj._members.values())
-        self._created = self._created.union(identityset_to_set(db.new))
-        self._updated = self._updated.union(identityset_to_set(db.dirty))
-        self._deleted = self._deleted.union(identityset_to_set(db.deleted))
+        changes = self._pending_changes(db)
+        self._collect_idents(changes['created'], db.new)
+        self._collect_idents(changes['updated'], db.dirty)
+        self._collect_idents(changes['deleted'], db.deleted)
+        if self.track_fields:
+            self._collect_fields(changes['fields'], db.dirty)
 
     def _after_commit(self, db):
         if db.transaction.nested:
             #NOTE: `after_commit` is called within `_flush` for nested
             #      transactions and this is unexpected behavior
             return
-        self._populate_idents_dict(self.created_idents, self._created)
-        self._populate_idents_dict(self.updated_idents, self._updated)
-        self._populate_idents_dict(self.deleted_idents, self._deleted)
-        self.clear_cache()
+        with self._lock:
+            changes = self._pending.pop(db, None)
+            if changes is None:
+                return
+            self._merge(changes)
+        if self.callback is not None and any(changes.values()):
+            self.callback(changes)
+
+    def _merge(self, changes):
+        for cls, cls_changes in changes['fields'].items():
+            fields = self.updated_fields.setdefault(cls, {})
+            for ident, changed in cls_changes.items():
+                previous = fields.setdefault(ident, {})
+                for name, (old, new) in changed.items():
+                    if name in previous:
+                        old = previous[name][0]
+                    previous[name] = (old, new)
+        for mode in ('created', 'updated', 'deleted'):
+            objects = changes[mode]
+            self._populate_idents_dict(getattr(self, '%s_idents' % mode),
+                                       objects)
+            counters = self.counters[mode]
+            for cls, cls_idents in objects.items():
+                counters[cls] = counters.get(cls, 0) + len(cls_idents)
+        if self.keep is not None:
+            for cls, fields in self.updated_fields.items():
+                kept = self.updated_idents.get(cls, {})
+                for ident in list(fields):
+                    if ident not in kept:
+                        del fields[ident]
 
     def _after_rollback(self, db, prev_tx):
-        self.clear_cache()
+        with self._lock:
+            self._pending.pop(db, None)
+
+
+class DBFingerprint(object):
+    '''Detects changes made to the database by any means (ORM, core, raw
+    SQL, triggers, other sessions and processes) comparing number of rows and
+    sum of row hashes of `tables` (list or `MetaData`), both computed by
+    database. Hashes of rows are kept in temporary tables, so rows of changed
+    tables only are compared and fetched.'''
+
+    def __init__(self, bind, tables):
+        self.session, self.bind = _session_bind(bind)
+        if isinstance(tables, MetaData):
+            tables = tables.sorted_tables
+        self.tables = list(tables)
+        self.before = {}
+        self.after = {}
+        self.changes = {}
+
+    def __enter__(self):
+        # DDL would commit transaction of session sharing DBAPI connection
+        # (in-memory SQLite), so row hashes are kept in memory then. Closing
+        # of separate connection would roll the transaction back, so
+        # connection of the session is used.
+        in_memory = isinstance(self.bind.pool,
+                               (SingletonThreadPool, StaticPool))
+        self._shared = in_memory and self.session is not None
+        self._connection = None if self._shared else self.bind.connect()
+        dialect = self.connection.dialect.name
+        if dialect == 'sqlite':
+            self.connection.connection.create_function(
+                'testalchemy_hash', -1, _row_hash)
+        self._snapshots = {}
+        snapshots = MetaData()
+        for i, table in enumerate(self.tables):
+            keys = list(table.primary_key.columns)
+            if keys and in_memory:
+                self._snapshots[table] = dict(
+                    (tuple(row[:-1]), row[-1])
+                    for row in self.connection.execute(
+                        select(keys + [self._hash(table)])))
+            elif keys:
+                snapshot = Table(
+                    'testalchemy_snapshot_%d' % i, snapshots,
+                    *[Column(c.name, c.type) for c in keys] +
+                    [Column('testalchemy_hash', BigInteger)],
+                    prefixes=['TEMPORARY'])
+                snapshot.create(self.connection)
+                self.connection.execute(snapshot.insert().from_select(
+                    [c.name for c in snapshot.columns],
+                    select(keys + [self._hash(table)])))
+                self._snapshots[table] = snapshot
+        self.before = self.snapshot()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        try:
+            self.after = self.snapshot()
+            self.changes = {}
+            for table in self.tables:
+                if self.before[table.name] != self.after[table.name]:
+                    self.changes[table.name] = self._diff(table)
+        finally:
+            for snapshot in self._snapshots.values():
+                if isinstance(snapshot, Table):
+                    snapshot.drop(self.connection)
+            if not self._shared:
+                self._connection.close()
+            del self._connection, self._snapshots
+
+    @property
+    def connection(self):
+        # session may be committed inside the block
+        if self._shared:
+            return self.session.connection()
+        return self._connection
+
+    def _hash(self, table):
+        return _row_hash_expression(self.connection.dialect.name,
+                                    list(table.columns))
+
+    def snapshot(self):
+        '''Returns dict of table name -> (number of rows, sum of row
+        hashes)'''
+        result = {}
+        for table in self.tables:
+            count, total = self.connection.execute(select(
+                [func.count(), func.coalesce(func.sum(self._hash(table)), 0)]
+            ).select_from(table)).first()
+            result[table.name] = (count, int(total))
+        return result
+
+    def _diff(self, table):
+        changes = {'before': self.before[table.name],
+                   'after': self.after[table.name]}
+        snapshot = self._snapshots.get(table)
+        if snapshot is None:
+            # rows of tables without primary key can't be matched
+            return changes
+        keys = list(table.primary_key.columns)
+        if isinstance(snapshot, dict):
+            return self._diff_in_memory(table, keys, snapshot, changes)
+        joined = table.outerjoin(snapshot, and_(*[
+            key == snapshot.c[key.name] for key in keys]))
+        missing = snapshot.c[keys[0].name] == None
+        changes['created'] = self.connection.execute(
+            select([table]).select_from(joined).where(missing)).fetchall()
+        changes['updated'] = self.connection.execute(
+            select([table]).select_from(joined).where(and_(
+                ~missing,
+                snapshot.c.testalchemy_hash != self._hash(table)))).fetchall()
+        deleted = snapshot.outerjoin(table, and_(*[
+            key == snapshot.c[key.name] for key in keys]))
+        changes['deleted'] = [tuple(row) for row in self.connection.execute(
+            select([snapshot.c[key.name] for key in keys])
+            .select_from(deleted).where(keys[0] == None)).fetchall()]
+        return changes
+
+    def _diff_in_memory(self, table, keys, snapshot, changes):
+        index = dict((column.name, i)
+                     for i, column in enumerate(table.columns))
+        positions = [index[key.name] for key in keys]
+        changes['created'] = []
+        changes['updated'] = []
+        seen = set()
+        for row in self.connection.execute(
+                select(list(table.columns) + [self._hash(table)])):
+            row = tuple(row)
+            ident = tuple(row[i] for i in positions)
+            seen.add(ident)
+            if ident not in snapshot:
+                changes['created'].append(row[:-1])
+            elif snapshot[ident] != row[-1]:
+                changes['updated'].append(row[:-1])
+        changes['deleted'] = [ident for ident in snapshot
+                              if ident not in seen]
+        return changes
+
+    def assert_nothing_happened(self):
+        if self.changes:
+            raise AssertionError('Tables are changed: %s' % ', '.join(
+                '%s (%d -> %d rows%s)' % (
+                    name, changes['before'][0], changes['after'][0],
+                    ''.join(', %d %s' % (len(changes[mode]), mode)
+                            for mode in ('created', 'updated', 'deleted')
+                            if changes.get(mode)))
+                for name, changes in sorted(self.changes.items())))
+
+
+class QueryCounter(object):
+
+    def __init__(self, bind):
+        self.session, self.bind = _session_bind(bind)
+        self.clear()
+
+    def clear(self):
+        self.statements = {}
+        self.verbs = {}
+        self.tables = {}
+        self.flushes = 0
+        self.commits = 0
+
+    def count(self, verb=None, table=None):
+        if table is not None:
+            counts = self.tables.get(table, {})
+        else:
+            counts = self.verbs
+        if verb is not None:
+            return counts.get(verb.upper(), 0)
+        return sum(counts.values())
+
+    def assert_max_queries(self, count, verb=None, table=None):
+        actual = self.count(verb, table)
+        if actual > count:
+            raise AssertionError('%d %s statement(s)%s executed, '
+                                 'expected at most %d' % (
+                                     actual, verb or 'SQL',
+                                     table and ' on %s' % table or '',
+                                     count))
+        return actual
+
+    def repeated_selects(self):
+        return dict((statement, count)
+                    for statement, count in self.statements.items()
+                    if count > 1 and _statement_verb(statement) == 'SELECT')
+
+    def assert_no_repeated_selects(self):
+        repeated = self.repeated_selects()
+        if repeated:
+            raise AssertionError('Repeated SELECT statement(s):\n%s' % (
+                '\n'.join('%d times: %s' % (count, statement)
+                          for statement, count in repeated.items())))
+
+    def __enter__(self):
+        _listen(self.bind, 'before_cursor_execute',
+                self._before_cursor_execute)
+        if self.session is not None:
+            _listen(self.session, 'after_flush', self._after_flush)
+            _listen(self.session, 'after_commit', self._after_commit)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        _unlisten(self.bind, 'before_cursor_execute',
+                  self._before_cursor_execute)
+        if self.session is not None:
+            _unlisten(self.session, 'after_flush', self._after_flush)
+            _unlisten(self.session, 'after_commit', self._after_commit)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        verb = _statement_verb(statement)
+        self.statements[statement] = self.statements.get(statement, 0) + 1
+        self.verbs[verb] = self.verbs.get(verb, 0) + 1
+        for table in _statement_tables(statement, context):
+            counts = self.tables.setdefault(table, {})
+            counts[verb] = counts.get(verb, 0) + 1
+
+    def _after_flush(self, db, flush_context, instances=None):
+        self.flushes += 1
+
+    def _after_commit(self, db):
+        if db.transaction.nested:
+            return
+        self.commits += 1
+
+
+class QueryProfiler(object):
+
+    def __init__(self, bind):
+        self.bind = _session_bind(bind)[1]
+        self.clear()
+
+    def clear(self):
+        self.queries = {}
+        self.properties = {}
+
+    def report(self):
+        result = []
+        for fingerprint, (times, rows) in self.queries.items():
+            times = sorted(times)
+            result.append({
+                'fingerprint': fingerprint,
+                'count': len(times),
+                'total': sum(times),
+                'p50': _percentile(times, 50),
+                'p95': _percentile(times, 95),
+                'max': times[-1],
+                'rows': rows,
+            })
+        result.sort(key=lambda item: item['total'], reverse=True)
+        return result
+
+    def slowest(self, limit=10):
+        return self.report()[:limit]
+
+    def to_json(self, **kwargs):
+        return json.dumps({'queries': self.report(),
+                           'properties': self.properties}, **kwargs)
+
+    def print_report(self, stream=None, limit=None):
+        stream = stream or sys.stdout
+        stream.write('%8s %10s %10s %10s %10s %8s  %s\n' % (
+            'count', 'total', 'p50', 'p95', 'max', 'rows', 'statement'))
+        for item in self.report()[:limit]:
+            stream.write('%(count)8d %(total)10.4f %(p50)10.4f %(p95)10.4f '
+                         '%(max)10.4f %(rows)8d  %(fingerprint)s\n' % item)
+        if self.properties:
+            stream.write('\n%8s %10s  %s\n' % ('count', 'total', 'property'))
+            properties = sorted(self.properties.items(),
+                                key=lambda item: item[1][1], reverse=True)
+            for name, (count, total) in properties:
+                stream.write('%8d %10.4f  %s\n' % (count, total, name))
+
+    def __enter__(self):
+        _listen(self.bind, 'before_cursor_execute',
+                self._before_cursor_execute)
+        _listen(self.bind, 'after_cursor_execute', self._after_cursor_execute)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        _unlisten(self.bind, 'before_cursor_execute',
+                  self._before_cursor_execute)
+        _unlisten(self.bind, 'after_cursor_execute',
+                  self._after_cursor_execute)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        conn.info.setdefault('testalchemy_query_start', []).append(
+            time.time())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        elapsed = time.time() - conn.info['testalchemy_query_start'].pop()
+        fingerprint = _fingerprint(statement)
+        query = self.queries.setdefault(fingerprint, [[], 0])
+        query[0].append(elapsed)
+        if cursor.rowcount > 0:
+            query[1] += cursor.rowcount
+        # time of statements executed while a sample property is being
+        # materialized is attributed to the property
+        stack = _materializing_stack()
+        if stack:
+            prop = self.properties.setdefault(stack[-1], [0, 0])
+            prop[0] += 1
+            prop[1] += elapsed
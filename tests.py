@@ -1,16 +1,54 @@
 # -*- coding: utf-8 -*-
 
+import gc
+import time
+import threading
+import os
+import json
+import shutil
+import tempfile
 import types
+import weakref
 import unittest
-from testalchemy import Sample, Restorable, DBHistory, sample_property
+from testalchemy import Sample, SampleCache, Restorable, DBHistory, \
+        DBFingerprint, QueryCounter, QueryProfiler, DatabasePool, \
+        SharedDatabase, sample_property, batch, seq, dump_sample, load_tables, \
+        _FileLock
 import sqlalchemy.exc
 from sqlalchemy import (
         MetaData, Table, Column, String, Integer, ForeignKey,
-        create_engine, UniqueConstraint)
-from sqlalchemy.orm import relation, sessionmaker, scoped_session
+        create_engine, UniqueConstraint, event, text)
+from sqlalchemy.orm import relation, sessionmaker, scoped_session, \
+        object_session
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+try:
+    import asyncio
+    import aiosqlite
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, \
+            async_scoped_session
+except ImportError:
+    AsyncSession = None
 from sqlalchemy.ext.declarative import declarative_base
 
 
+# `async` syntax can't be compiled on Python 2
+ASYNC_SCENARIO = '''
+async def async_scenario(session, sample_cls):
+    async with Restorable(session):
+        async with DBHistory(session) as history:
+            await sample_cls(session).create_all_async()
+        history.assert_created_count(User, 1)
+        john = await history.assert_created_one_async(User)
+        names = [user.name for user in await history.last_created_async(User)]
+        assert names == [john.name]
+    result = await session.execute(text('SELECT count(*) FROM users'))
+    return names, result.scalar()
+'''
+
+
 metadata = MetaData()
 Model = declarative_base(metadata=metadata, name='Model')
 
@@ -18,7 +56,7 @@ Model = declarative_base(metadata=metadata, name='Model')
 class User(Model):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
-    name = Column(String(255), nullable=False, default='')
+    name = Column(String(255), nullable=False, default='', index=True)
     roles = relation('Role', passive_deletes='all')
 
 
@@ -46,6 +84,13 @@ class Smi(Model):
     roles = relation(Role, passive_deletes='all')
 
 
+class Label(Model):
+    __tablename__ = 'labels'
+    smi_id = Column(ForeignKey(Smi.id, ondelete='CASCADE'), primary_key=True)
+    code = Column(String(32), primary_key=True)
+    smi = relation(Smi)
+
+
 roles_category = Table('roles_category', metadata, 
     Column('role_id', ForeignKey(Role.id, ondelete='CASCADE'), nullable=False),
     Column('category_id', ForeignKey(Category.id, ondelete='CASCADE'), nullable=False),
@@ -53,6 +98,8 @@ roles_category = Table('roles_category', metadata,
 )
 
 EMPTY = object()
+# plain functions are not turned into unbound methods on Python 3
+METHOD = getattr(types, 'UnboundMethodType', types.FunctionType)
 
 
 class Test(unittest.TestCase):
@@ -68,6 +115,18 @@ class Test(unittest.TestCase):
         metadata.create_all(engine)
         return scoped_session(sessionmaker(bind=engine, **kwargs))
 
+    def savepoint_engine(self):
+        # pysqlite needs help to handle SAVEPOINT properly
+        engine = create_engine('sqlite:///:memory:', echo=False)
+        @event.listens_for(engine, 'connect')
+        def connect(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+        @event.listens_for(engine, 'begin')
+        def begin(conn):
+            conn.execute('BEGIN')
+        metadata.create_all(engine)
+        return engine
+
     def tearDown(self):
         self.session.close()
 
@@ -153,6 +212,189 @@ class Test(unittest.TestCase):
             session.commit()
         self.assertEqual(self.session.query(Smi).all(), [])
 
+    def test_restorable_deletes_association_rows(self):
+        session = self.session
+        with Restorable(session):
+            role = Role(user=User(name='john'), smi=Smi(name='newspaper'),
+                        categories=[Category(name='cat1')])
+            session.add(role)
+            session.commit()
+        self.assertEqual(session.execute(roles_category.select()).fetchall(),
+                         [])
+        self.assertEqual(session.query(Role).all(), [])
+
+    def test_restorable_batches_deletes(self):
+        session = self.session
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            if statement.startswith('DELETE'):
+                statements.append(statement)
+        engine = session.get_bind()
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        with Restorable(session, max_params=4):
+            smi = Smi(name='newspaper')
+            session.add_all([Label(smi=smi, code=str(i)) for i in range(5)])
+            session.add_all([User(name=str(i)) for i in range(10)])
+            session.commit()
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(session.query(Label).all(), [])
+        self.assertEqual(session.query(Smi).all(), [])
+        self.assertEqual(session.query(User).all(), [])
+        # labels go first: 5 identities of 2 columns by 2 per statement
+        self.assertEqual(len(statements), 3 + 1 + 3)
+        self.assertTrue(all('labels' in s for s in statements[:3]))
+
+    def test_restorable_with_several_binds(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        engines = []
+        threads = set()
+        for name in ('users', 'smi'):
+            engine = create_engine(
+                'sqlite:///' + os.path.join(directory, name + '.sqlite'))
+            metadata.create_all(engine)
+            @event.listens_for(engine, 'before_cursor_execute')
+            def before_cursor_execute(conn, cursor, statement, *args):
+                if statement.startswith('DELETE'):
+                    threads.add(threading.current_thread())
+            engines.append(engine)
+        session = self.Session(binds={User: engines[0], Smi: engines[1],
+                                      Label: engines[1]})
+        other = self.Session(bind=engines[1])
+        with Restorable([session, other]):
+            smi = Smi(name='newspaper')
+            session.add_all([User(name='john'), smi,
+                             Label(smi=smi, code='a')])
+            session.commit()
+            other.add(Smi(name='other'))
+            other.commit()
+        self.assertEqual(engines[0].execute('SELECT * FROM users').fetchall(),
+                         [])
+        for table in ('smi', 'labels'):
+            self.assertEqual(engines[1].execute(
+                'SELECT * FROM %s' % table).fetchall(), [])
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_restorable_rollback_strategy(self):
+        session = sessionmaker(bind=self.savepoint_engine())()
+        session.add(Smi(name='existing'))
+        session.commit()
+        with Restorable(session, strategy='rollback'):
+            smi = Smi(name='newspaper')
+            session.add(smi)
+            session.commit()
+            session.add(Smi(name='rolled back'))
+            session.flush()
+            session.rollback()
+            self.assertEqual(
+                sorted(s.name for s in session.query(Smi).all()),
+                ['existing', 'newspaper'])
+            role = Role(user=User(name='john'), smi=smi)
+            session.add(role)
+            session.commit()
+        self.assertEqual([s.name for s in session.query(Smi).all()],
+                         ['existing'])
+        self.assertEqual(session.query(User).all(), [])
+        self.assertEqual(session.query(Role).all(), [])
+
+    def test_restorable_rollback_strategy_requires_savepoint_workaround(self):
+        restorable = Restorable(self.session, strategy='rollback')
+        self.assertRaises(RuntimeError, restorable.__enter__)
+        self.session.add(Smi(name='newspaper'))
+        self.session.commit()
+        self.assertEqual(self.session.query(Smi).count(), 1)
+
+    def test_restorable_rollback_strategy_with_scoped_session_and_autocommit(
+            self):
+        session = scoped_session(sessionmaker(bind=self.savepoint_engine(),
+                                              autocommit=True))
+        with Restorable(session, strategy='rollback'):
+            session.begin()
+            session.add(Smi(name='newspaper'))
+            session.commit()
+            session.begin()
+            session.add(Smi(name='rolled back'))
+            session.flush()
+            session.rollback()
+            self.assertEqual([s.name for s in session.query(Smi).all()],
+                             ['newspaper'])
+        self.assertEqual(session.query(Smi).all(), [])
+
+    def test_restorable_truncate_strategy(self):
+        session = self.session
+        restorable = Restorable(session, strategy='truncate')
+        with restorable:
+            role = Role(user=User(name='john'), smi=Smi(name='newspaper'),
+                        categories=[Category(name='cat1')])
+            session.add(role)
+            session.commit()
+            session.execute(Label.__table__.insert(),
+                            [{'smi_id': role.smi.id, 'code': 'a'},
+                             {'smi_id': role.smi.id, 'code': 'b'}])
+            session.commit()
+        self.assertEqual(set(t.name for t in restorable.dirty_tables),
+                         set(['users', 'smi', 'roles', 'categories',
+                              'roles_category', 'labels']))
+        for table in metadata.sorted_tables:
+            self.assertEqual(session.execute(table.select()).fetchall(), [])
+
+    def test_restorable_truncate_strategy_with_textual_sql(self):
+        session = self.session
+        session.add(User(name='john'))
+        session.commit()
+        with Restorable(session, strategy='truncate'):
+            session.execute("INSERT INTO smi (name) VALUES ('newspaper')")
+            session.execute("INSERT INTO categories (name) "
+                            "SELECT name FROM users")
+            session.commit()
+        self.assertEqual(session.query(Smi).count(), 0)
+        self.assertEqual(session.query(Category).count(), 0)
+        self.assertEqual(session.query(User).count(), 1)
+        restorable = Restorable(session, strategy='truncate')
+        with restorable:
+            session.add(Smi(name='newspaper'))
+            session.flush()
+            session.execute("UPDATE users SET name = 'John'")
+            session.commit()
+        self.assertEqual(set(t.name for t in restorable.dirty_tables),
+                         set(['smi', 'users']))
+        self.assertEqual(session.query(User).count(), 0)
+
+    def test_restorable_undo_strategy(self):
+        session = self.session
+        smi = Smi(name='newspaper')
+        john = User(name='john')
+        bob = User(name='bob')
+        role = Role(user=john, smi=smi)
+        labels = [Label(smi=smi, code='a'), Label(smi=smi, code='b')]
+        session.add_all([role, bob] + labels)
+        session.commit()
+        def dump():
+            return dict((table.name,
+                         sorted(session.execute(table.select()).fetchall()))
+                        for table in metadata.sorted_tables)
+        before = dump()
+        with Restorable(session, strategy='undo'):
+            john.name = 'john 1'
+            session.flush()
+            john.name = 'john 2'
+            role.user = User(name='alice')
+            session.commit()
+            session.delete(labels[0])
+            session.delete(bob)
+            session.commit()
+            session.delete(session.query(User).filter_by(name='alice').one())
+            session.commit()
+            smi.roles.remove(role)
+            session.add(Smi(name='magazine', roles=[role]))
+            session.commit()
+            # uncommitted changes are not logged
+            session.delete(smi)
+            session.flush()
+            session.rollback()
+        self.assertEqual(dump(), before)
+
     def test_models_history_init(self):
         with DBHistory(self.session) as history:
             self.assertEqual(history.created_idents, {})
@@ -285,6 +527,252 @@ class Test(unittest.TestCase):
             session.add(user1)
             session.commit()
 
+    def test_models_history_with_flushes_in_loop(self):
+        session = self.session
+        with DBHistory(session) as history:
+            for i in range(10):
+                user = User(name='test%d' % i)
+                session.add(user)
+                session.flush()
+            # instances are not referenced by history between flushes
+            user_ref = weakref.ref(user)
+            del user
+            gc.collect()
+            self.assertEqual(user_ref(), None)
+            session.commit()
+            self.assertEqual(history.created_idents,
+                             {User: set((i,) for i in range(1, 11))})
+
+    def test_models_history_loads_objects_in_bulk(self):
+        session = self.session
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            if statement.startswith('SELECT'):
+                statements.append(statement)
+        with DBHistory(session) as history:
+            session.add_all([User(name='test%d' % i) for i in range(5)])
+            session.commit()
+            session.add(User(name='test5'))
+            session.flush()
+            session.add_all([Label(smi=Smi(name='newspaper'), code=str(i))
+                             for i in range(3)])
+            session.commit()
+            session.expunge_all()
+            engine = session.get_bind()
+            event.listen(engine, 'before_cursor_execute',
+                         before_cursor_execute)
+            self.assertEqual(history.count_created(User), 6)
+            history.assert_created_count(User, 6)
+            self.assertRaises(AssertionError,
+                              history.assert_created_count, User, 5)
+            history.assert_updated_count(User, 0)
+            self.assertEqual(statements, [])
+            users = history.assert_created(User)
+            self.assertEqual(sorted(u.name for u in users),
+                             ['test%d' % i for i in range(6)])
+            self.assertEqual(len(statements), 1)
+            # served from the identity map
+            self.assertEqual(history.last_created(User), users)
+            self.assertEqual(len(statements), 1)
+            labels = history.last_created(Label)
+            self.assertEqual(sorted(l.code for l in labels), ['0', '1', '2'])
+            self.assertEqual(len(statements), 2)
+            event.remove(engine, 'before_cursor_execute',
+                         before_cursor_execute)
+
+    def test_models_history_with_models(self):
+        session = self.session
+        def add_all():
+            smi = Smi(name='newspaper')
+            session.add_all([User(name='test'), smi, Label(smi=smi, code='a')])
+            session.commit()
+        with DBHistory(session, models=[User, Smi]) as history:
+            add_all()
+            self.assertEqual(set(history.created_idents), set([User, Smi]))
+        with DBHistory(session, models=Label) as history:
+            add_all()
+            self.assertEqual(set(history.created_idents), set([Label]))
+        predicate = lambda cls: cls.__name__.startswith('S')
+        with DBHistory(session, models=predicate) as history:
+            add_all()
+            self.assertEqual(set(history.created_idents), set([Smi]))
+            history.assert_created_one(Smi)
+
+    def test_models_history_bounded(self):
+        session = self.session
+        changes = []
+        with DBHistory(session, keep=2, callback=changes.append,
+                       track_fields=True) as history:
+            for i in range(5):
+                session.add(User(name='user%d' % i))
+                session.commit()
+            user = session.query(User).get(1)
+            user.name = 'updated'
+            session.commit()
+            session.query(User).all()
+            session.commit()
+        self.assertEqual(list(history.created_idents[User]), [(4,), (5,)])
+        history.assert_changes_count(User, 5, 'created')
+        # user updated in one transaction and loaded in another
+        history.assert_changes_count(User, 1, 'updated')
+        self.assertRaises(ValueError, history.assert_created_count, User, 5)
+        history.assert_created(User, 5)
+        self.assertRaises(AssertionError, history.assert_created, User, 1)
+        self.assertEqual(history.assert_updated_one(User), user)
+        self.assertEqual(len(changes), 6)
+        self.assertEqual(changes[0]['created'], {User: set([(1,)])})
+        self.assertEqual(changes[-1]['updated'], {User: set([(1,)])})
+        self.assertEqual(changes[-1]['fields'],
+                         {User: {(1,): {'name': ('user0', 'updated')}}})
+        self.assertEqual(history.updated_fields[User],
+                         {(1,): {'name': ('user0', 'updated')}})
+        with DBHistory(session, keep=0) as history:
+            session.add(User(name='user'))
+            session.commit()
+        self.assertEqual(history.created_idents, {User: {}})
+        history.assert_changes_count(User, 1, 'created')
+        history.assert_created(User)
+        self.assertRaises(AssertionError, history.assert_nothing_happened)
+
+    def test_models_history_updated_fields(self):
+        session = self.session
+        session.add_all([User(name='john'), User(name='bob')])
+        session.commit()
+        john, bob = session.query(User).order_by(User.id).all()
+        with DBHistory(session, track_fields=True) as history:
+            john.name = 'John'
+            session.flush()
+            john.name = 'Johnny'
+            bob.name = 'Bob'
+            session.commit()
+            session.query(User).all()
+        self.assertEqual(history.updated_fields[User], {
+            (1,): {'name': ('john', 'Johnny')},
+            (2,): {'name': ('bob', 'Bob')},
+        })
+        counter = QueryCounter(session)
+        with counter:
+            history.assert_updated(User, 1, fields={'name'})
+            history.assert_updated(User, fields={'name': 'Bob'})
+        self.assertEqual(counter.count(), 0)
+        self.assertRaises(AssertionError, history.assert_updated, User, 1,
+                          fields={'name': 'Bob'})
+        self.assertRaises(AssertionError, history.assert_updated, User,
+                          fields={'id'})
+        with DBHistory(session) as history:
+            john.name = 'john'
+            session.commit()
+        self.assertRaises(AssertionError, history.assert_updated, User,
+                          fields={'name'})
+
+    def test_models_history_process_wide(self):
+        engine = create_engine('sqlite:///' + os.path.join(
+            tempfile.mkdtemp(), 'test.sqlite'))
+        self.addCleanup(shutil.rmtree, os.path.dirname(engine.url.database))
+        metadata.create_all(engine)
+        Session = sessionmaker(bind=engine)
+        def work(i):
+            session = Session()
+            session.add(User(name='user%d' % i))
+            session.flush()
+            if i % 2:
+                session.rollback()
+            else:
+                session.commit()
+            session.close()
+        with DBHistory(Session) as history:
+            threads = [threading.Thread(target=work, args=(i,))
+                       for i in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.session.add(User(name='other'))
+            self.session.commit()
+        history.assert_created_count(User, 5)
+        created = history.last_created(User)
+        self.assertEqual(set(user.name for user in created),
+                         set('user%d' % i for i in range(0, 10, 2)))
+        self.assertEqual(set(object_session(user) for user in created),
+                         set([None]))
+
+    def test_nested_recorders_share_listeners(self):
+        session = self.session
+        def create(name):
+            session.add(User(name=name))
+            session.commit()
+        with DBHistory(session) as outer:
+            with Restorable(session):
+                create('john')
+                with DBHistory(session) as inner:
+                    create('bob')
+                    self.assertEqual(len(session.dispatch.after_flush), 1)
+                create('ann')
+                with DBHistory(session) as other:
+                    create('kate')
+        self.assertEqual(len(session.dispatch.after_flush), 1)
+        outer.assert_created_count(User, 4)
+        inner.assert_created_count(User, 1)
+        other.assert_created_count(User, 1)
+        self.assertEqual(session.query(User).count(), 0)
+
+    def test_db_fingerprint(self):
+        engine = create_engine('sqlite:///' + os.path.join(
+            tempfile.mkdtemp(), 'test.sqlite'))
+        self.addCleanup(shutil.rmtree, os.path.dirname(engine.url.database))
+        metadata.create_all(engine)
+        # row hashes of in-memory database are kept in memory, of other
+        # databases in temporary tables
+        for session in [self.session, sessionmaker(bind=engine)()]:
+            smi = Smi(name='newspaper')
+            session.add_all([User(name='john'), User(name='bob'), smi,
+                             Label(smi=smi, code='a'),
+                             Label(smi=smi, code='b')])
+            session.commit()
+            with DBFingerprint(session, metadata) as fingerprint:
+                session.query(User).all()
+            self.assertEqual(fingerprint.before, fingerprint.after)
+            self.assertEqual(fingerprint.before['users'][0], 2)
+            fingerprint.assert_nothing_happened()
+            with DBFingerprint(session, metadata) as fingerprint:
+                session.execute("UPDATE users SET name = 'John' WHERE id = 1")
+                session.execute(Smi.__table__.insert(), {'name': 'other'})
+                session.execute("DELETE FROM labels WHERE code = 'b'")
+                session.commit()
+            self.assertEqual(set(fingerprint.changes), set(['users', 'smi',
+                                                            'labels']))
+            users = fingerprint.changes['users']
+            self.assertEqual(users['before'][0], users['after'][0])
+            self.assertEqual(users['updated'], [(1, 'John')])
+            self.assertEqual(users['created'], [])
+            self.assertEqual(users['deleted'], [])
+            self.assertEqual(fingerprint.changes['smi']['created'],
+                             [(2, 'other')])
+            self.assertEqual(fingerprint.changes['labels']['deleted'],
+                             [(1, 'b')])
+            with self.assertRaises(AssertionError) as context:
+                fingerprint.assert_nothing_happened()
+            self.assertEqual(str(context.exception), 'Tables are changed: '
+                             'labels (2 -> 1 rows, 1 deleted), '
+                             'smi (1 -> 2 rows, 1 created), '
+                             'users (2 -> 2 rows, 1 updated)')
+            session.close()
+
+    def test_db_fingerprint_keeps_session_transaction(self):
+        session = self.session
+        session.add(User(name='john'))
+        session.flush()
+        with DBFingerprint(session, metadata) as fingerprint:
+            session.execute("UPDATE users SET name = 'John'")
+        self.assertEqual(fingerprint.changes['users']['updated'],
+                         [(1, 'John')])
+        self.assertEqual(session.query(User).count(), 1)
+        with DBFingerprint(session, metadata):
+            pass
+        self.assertEqual(session.query(User).count(), 1)
+        session.rollback()
+        self.assertEqual(session.query(User).count(), 0)
+
     def test_nothing_happened_does_not_throw_when_nothing_happened(self):
         session = self.session
         with DBHistory(session) as history:
@@ -321,6 +809,77 @@ class Test(unittest.TestCase):
         with self.assertRaises(AssertionError):
             history.assert_nothing_happened()
 
+    def test_query_counter(self):
+        session = self.session
+        smi = Smi(name='newspaper')
+        session.add_all([Role(user=User(name='test%d' % i), smi=smi)
+                         for i in range(3)])
+        session.commit()
+        session.expunge_all()
+        with QueryCounter(session) as counter:
+            roles = session.query(Role).all()
+            [role.user.name for role in roles]
+            session.add(User(name='test'))
+            session.commit()
+        self.assertEqual(counter.count('SELECT'), 4)
+        self.assertEqual(counter.count('SELECT', 'users'), 3)
+        self.assertEqual(counter.count('SELECT', 'roles'), 1)
+        self.assertEqual(counter.count('INSERT', 'users'), 1)
+        self.assertEqual(counter.count(table='users'), 4)
+        self.assertEqual(counter.flushes, 1)
+        self.assertEqual(counter.commits, 1)
+        counter.assert_max_queries(5)
+        counter.assert_max_queries(1, 'insert')
+        self.assertRaises(AssertionError, counter.assert_max_queries, 4)
+        self.assertRaises(AssertionError, counter.assert_max_queries,
+                          2, 'SELECT', 'users')
+        self.assertRaises(AssertionError, counter.assert_no_repeated_selects)
+
+    def test_query_counter_with_engine_and_textual_sql(self):
+        session = self.scoped_session()
+        engine = session.get_bind()
+        with QueryCounter(engine) as counter:
+            session.execute('SELECT * FROM users JOIN roles '
+                            'ON users.id = roles.user_id')
+            session.query(User).all()
+        self.assertEqual(counter.count(), 2)
+        self.assertEqual(counter.count('SELECT', 'roles'), 1)
+        self.assertEqual(counter.count('SELECT', 'users'), 2)
+        counter.assert_no_repeated_selects()
+        self.assertEqual(counter.flushes, 0)
+
+    def test_query_profiler(self):
+        session = self.session
+        class DataSample(Sample):
+            def newspaper(self):
+                return Smi(name='newspaper')
+            def editor(self):
+                self.newspaper
+                # autoflush inserts newspaper
+                smi = self.db.query(Smi).filter_by(name='newspaper').one()
+                return Role(user=User(name='john'), smi=smi)
+        with QueryProfiler(session) as profiler:
+            DataSample(session).create_all()
+            session.query(User).filter(User.id.in_([1, 2])).all()
+            session.query(User).filter(User.id.in_([1, 2, 3])).all()
+        report = profiler.report()
+        fingerprints = [item['fingerprint'] for item in report]
+        self.assertEqual(len(fingerprints), len(set(fingerprints)))
+        self.assertEqual(sum(item['count'] for item in report), 6)
+        users_select = [item for item in report
+                        if item['fingerprint'].endswith('IN (?)')]
+        self.assertEqual(len(users_select), 1)
+        self.assertEqual(users_select[0]['count'], 2)
+        for item in report:
+            self.assertTrue(item['p50'] <= item['p95'] <= item['max'])
+        self.assertEqual(list(profiler.properties), ['DataSample.editor'])
+        self.assertEqual(profiler.properties['DataSample.editor'][0], 2)
+        self.assertEqual(json.loads(profiler.to_json())['queries'][0]['count'],
+                         report[0]['count'])
+        stream = StringIO()
+        profiler.print_report(stream)
+        self.assertTrue('DataSample.editor' in stream.getvalue())
+
     def test_sample_properties(self):
         class TestSample(Sample):
             def method(self):
@@ -328,7 +887,7 @@ class Test(unittest.TestCase):
             def _method(self):
                 pass
         self.assert_attr(TestSample, 'method', sample_property)
-        self.assert_attr(TestSample, '_method', types.MethodType)
+        self.assert_attr(TestSample, '_method', METHOD)
 
     def test_sample_properties_with_inheritance(self):
         class BaseTestSample(Sample):
@@ -343,8 +902,8 @@ class Test(unittest.TestCase):
                 pass
         self.assert_attr(TestSample, 'method', sample_property)
         self.assert_attr(TestSample, 'method1', sample_property)
-        self.assert_attr(TestSample, '_method', types.MethodType)
-        self.assert_attr(TestSample, '_method1', types.MethodType)
+        self.assert_attr(TestSample, '_method', METHOD)
+        self.assert_attr(TestSample, '_method1', METHOD)
 
     def test_sample_creation(self):
         class DataSample(Sample):
@@ -369,6 +928,207 @@ class Test(unittest.TestCase):
         self.assertEqual(self.session.query(Smi).all(),
                          [sample.newspaper])
 
+    def test_sample_bulk_creation(self):
+        class DataSample(Sample):
+            def john(self):
+                return User(name='john')
+            def categories(self):
+                return [Category(id=i, name='cat%d' % i)
+                        for i in range(1, 51)]
+            def newspaper_editor(self):
+                return Role(user=self.john, smi=self.newspaper,
+                            categories=self.categories[:2])
+            def newspaper(self):
+                return Smi(name='newspaper')
+            def magazine(self):
+                return Smi(name='magazine',
+                           roles=[Role(user=User(name='bob'))])
+        sample = DataSample(self.session)
+        with QueryCounter(self.session) as counter:
+            sample.create_all(bulk=True)
+        self.assertEqual(counter.count('INSERT', 'categories'), 1)
+        self.assertEqual(counter.count('INSERT', 'roles_category'), 1)
+        self.assertEqual(counter.flushes, 0)
+        self.assertEqual(set(self.session.query(User).all()),
+                         set([sample.john, sample.magazine.roles[0].user]))
+        self.assertEqual(set(self.session.query(Category).all()),
+                         set(sample.categories))
+        self.assertEqual(
+            self.session.query(Role).filter_by(smi=sample.newspaper).one(),
+            sample.newspaper_editor)
+        self.assertEqual(sample.newspaper_editor.user, sample.john)
+        self.assertEqual(sample.newspaper_editor.smi, sample.newspaper)
+        self.assertEqual(set(sample.newspaper_editor.categories),
+                         set(sample.categories[:2]))
+        self.assertEqual(sample.newspaper.roles, [sample.newspaper_editor])
+        self.assertEqual(sample.magazine.roles[0].user.name, 'bob')
+        self.assertEqual(self.session.query(Smi).count(), 2)
+        self.assertEqual(self.session.query(Role).count(), 2)
+
+    def test_sample_bulk_creation_with_autoincrement(self):
+        self.session.add(User(id=5, name='existing'))
+        self.session.commit()
+        class DataSample(Sample):
+            def users(self):
+                return [User(name='user%d' % i) for i in range(1500)] + \
+                        [User(id=7000, name='explicit')]
+            def roles(self):
+                return [Role(user=user, smi=self.newspaper)
+                        for user in self.users[:200]]
+            def newspaper(self):
+                return Smi(name='newspaper')
+        sample = DataSample(self.session)
+        with QueryCounter(self.session) as counter:
+            sample.create_all(bulk=True)
+        self.assertEqual(counter.count('INSERT', 'users'), 2)
+        self.assertEqual(counter.count('INSERT', 'roles'), 1)
+        self.assertEqual(counter.count('INSERT', 'smi'), 1)
+        self.assertEqual(sample.users[0].id, 7001)
+        self.assertEqual(self.session.query(User).count(), 1502)
+        self.assertEqual(set(role.user for role in
+                             self.session.query(Role).all()),
+                         set(sample.users[:200]))
+
+    def test_sample_partial_creation(self):
+        class DataSample(Sample):
+            def john(self):
+                return User(name='john')
+            def cat1(self):
+                return Category(name='cat1')
+            def cat2(self):
+                return Category(name='cat2')
+            def newspaper_editor(self):
+                return Role(user=self.john, smi=self.newspaper,
+                            categories=[self.cat1, self.cat2])
+            def newspaper(self):
+                return Smi(name='newspaper')
+            def magazine(self):
+                return Smi(name='magazine')
+            def magazine_editor(self):
+                return Role(user=self.john, smi=self.magazine)
+        sample = DataSample(self.session)
+        with QueryCounter(self.session) as counter:
+            sample.create('cat1', 'newspaper_editor')
+        self.assertEqual(counter.flushes, 1)
+        self.assertEqual(sample.used_properties,
+                         set(['john', 'cat1', 'cat2', 'newspaper',
+                              'newspaper_editor']))
+        self.assertEqual(self.session.query(Smi).all(), [sample.newspaper])
+        self.assertEqual(self.session.query(Role).all(),
+                         [sample.newspaper_editor])
+        self.assertEqual(sample.dependencies, {
+            'newspaper_editor': set(['john', 'newspaper', 'cat1', 'cat2'])})
+        sample.create('magazine_editor')
+        self.assertEqual(sample.dependencies['magazine_editor'],
+                         set(['john', 'magazine']))
+        self.assertEqual(sample.closure('magazine_editor'),
+                         set(['magazine_editor', 'john', 'magazine']))
+        self.assertRaises(AttributeError, sample.create, 'db')
+        self.assertRaises(AttributeError, sample.create, 'editor')
+        self.assertRaises(TypeError, sample.create, 'john', buk=True)
+
+    def test_sample_reserved_names(self):
+        def define(name):
+            return type('DataSample', (Sample,), {
+                name: lambda self: User(name='john')})
+        for name in ('seed', 'random', 'chunk_size', 'dependencies',
+                     'created_idents', 'create', 'closure', 'db'):
+            self.assertRaises(TypeError, define, name)
+        class Mixin(object):
+            def closure(self):
+                return User(name='john')
+        self.assertRaises(TypeError, type, 'DataSample', (Mixin, Sample), {})
+        class DataSample(Sample):
+            seed = 42
+            chunk_size = 10
+            def create_all(self, bulk=False):
+                Sample.create_all(self, bulk)
+            def john(self):
+                return User(name='john')
+        self.assertEqual(DataSample._sample_properties, ('john',))
+        DataSample(self.session).create_all()
+        self.assertEqual(self.session.query(User).count(), 1)
+
+    def test_sample_cache(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cache = SampleCache(metadata, directory)
+        calls = []
+        class DataSample(Sample):
+            def john(self):
+                calls.append('john')
+                return User(name='john')
+            def categories(self):
+                return (Category(name='cat1'), Category(name='cat2'))
+            def newspaper_editor(self):
+                return Role(user=self.john, smi=Smi(name='newspaper'),
+                            categories=list(self.categories))
+        # workers with cold cache materialize the template once
+        def create():
+            session = self.Session(bind=create_engine('sqlite://'))
+            metadata.create_all(session.get_bind())
+            cache.create(DataSample, session)
+            session.close()
+        threads = [threading.Thread(target=create) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, ['john'])
+        for i in range(2):
+            session = self.Session(bind=create_engine('sqlite://'))
+            metadata.create_all(session.get_bind())
+            sample = cache.create(DataSample, session)
+            self.assertEqual(calls, ['john'])
+            self.assertEqual(sample.used_properties,
+                             set(['john', 'categories', 'newspaper_editor']))
+            self.assertEqual(session.query(User).all(), [sample.john])
+            self.assert_attr(sample, 'categories', tuple)
+            self.assertEqual(set(session.query(Category).all()),
+                             set(sample.categories))
+            self.assertEqual(sample.newspaper_editor.user, sample.john)
+            self.assertEqual(sample.newspaper_editor.smi.name, 'newspaper')
+            self.assertEqual(sample.created_idents[Smi],
+                             set([(sample.newspaper_editor.smi.id,)]))
+            session.close()
+        # file database without schema
+        path = os.path.join(directory, 'test.sqlite')
+        session = self.Session(bind=create_engine('sqlite:///' + path))
+        sample = cache.create(DataSample, session)
+        self.assertEqual(session.query(User).all(), [sample.john])
+        self.assertEqual(calls, ['john'])
+        session.close()
+        class ChangedSample(DataSample):
+            def john(self):
+                calls.append('john')
+                return User(name='John')
+        self.assertNotEqual(cache.key(DataSample, session.bind.dialect),
+                            cache.key(ChangedSample, session.bind.dialect))
+        session = self.Session(bind=create_engine('sqlite://'))
+        sample = cache.create(ChangedSample, session)
+        self.assertEqual(calls, ['john', 'john'])
+        self.assertEqual(session.query(User).one().name, 'John')
+
+    def test_file_lock_held_longer_than_timeout(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'test.lock')
+        events = []
+        def hold():
+            with _FileLock(path, timeout=0.2):
+                events.append('acquired')
+                time.sleep(0.6)
+                events.append('released')
+        thread = threading.Thread(target=hold)
+        thread.start()
+        while not events:
+            time.sleep(0.01)
+        with _FileLock(path, timeout=0.2):
+            events.append('acquired')
+        thread.join()
+        self.assertEqual(events, ['acquired', 'released', 'acquired'])
+        self.assertFalse(os.path.exists(path))
+
     def test_sample_creation_with_scoped_session(self):
         session = self.scoped_session()
         class DataSample(Sample):
@@ -478,14 +1238,14 @@ class Test(unittest.TestCase):
                 pass
             def _method2(self):
                 pass
-        self.assert_attr(Mixin1, 'method', types.MethodType)
-        self.assert_attr(Mixin2, 'method1', types.MethodType)
+        self.assert_attr(Mixin1, 'method', METHOD)
+        self.assert_attr(Mixin2, 'method1', METHOD)
         self.assert_attr(TestSample, 'method', sample_property)
         self.assert_attr(TestSample, 'method1', sample_property)
         self.assert_attr(TestSample, 'method2', sample_property)
-        self.assert_attr(TestSample, '_method', types.MethodType)
-        self.assert_attr(TestSample, '_method1', types.MethodType)
-        self.assert_attr(TestSample, '_method2', types.MethodType)
+        self.assert_attr(TestSample, '_method', METHOD)
+        self.assert_attr(TestSample, '_method1', METHOD)
+        self.assert_attr(TestSample, '_method2', METHOD)
 
     def test_sample_with_inheritance_in_mixins(self):
         class Mixin1(object):
@@ -503,14 +1263,14 @@ class Test(unittest.TestCase):
                 pass
             def _method2(self):
                 pass
-        self.assert_attr(Mixin1, 'method', types.MethodType)
-        self.assert_attr(Mixin2, 'method1', types.MethodType)
+        self.assert_attr(Mixin1, 'method', METHOD)
+        self.assert_attr(Mixin2, 'method1', METHOD)
         self.assert_attr(TestSample, 'method', sample_property)
         self.assert_attr(TestSample, 'method1', sample_property)
         self.assert_attr(TestSample, 'method2', sample_property)
-        self.assert_attr(TestSample, '_method', types.MethodType)
-        self.assert_attr(TestSample, '_method1', types.MethodType)
-        self.assert_attr(TestSample, '_method2', types.MethodType)
+        self.assert_attr(TestSample, '_method', METHOD)
+        self.assert_attr(TestSample, '_method1', METHOD)
+        self.assert_attr(TestSample, '_method2', METHOD)
 
     def test_sample_with_oldstyle_mixin(self):
         class Mixin1(object):
@@ -531,9 +1291,275 @@ class Test(unittest.TestCase):
         self.assert_attr(TestSample, 'method', sample_property)
         self.assert_attr(TestSample, 'method1', sample_property)
         self.assert_attr(TestSample, 'method2', sample_property)
-        self.assert_attr(TestSample, '_method', types.MethodType)
-        self.assert_attr(TestSample, '_method1', types.MethodType)
-        self.assert_attr(TestSample, '_method2', types.MethodType)
+        self.assert_attr(TestSample, '_method', METHOD)
+        self.assert_attr(TestSample, '_method1', METHOD)
+        self.assert_attr(TestSample, '_method2', METHOD)
+
+    def test_sample_properties_registry(self):
+        class Mixin(object):
+            def mixin_method(self):
+                pass
+            def _mixin_method(self):
+                pass
+        class BaseTestSample(Sample):
+            def method(self):
+                pass
+            def overridden(self):
+                pass
+            def _method(self):
+                pass
+        class TestSample(BaseTestSample, Mixin):
+            @staticmethod
+            def overridden():
+                pass
+            renamed = BaseTestSample.method
+            def method1(self):
+                pass
+        self.assertEqual(Sample._sample_properties, ())
+        self.assertEqual(BaseTestSample._sample_properties,
+                         ('method', 'overridden'))
+        self.assertEqual(TestSample._sample_properties,
+                         ('method', 'method1', 'mixin_method', 'renamed'))
+
+    def test_sample_batch(self):
+        class DataSample(Sample):
+            def newspaper(self):
+                return Smi(id=1, name='newspaper')
+            users = batch(User, 2500, id=seq(start=1), name=seq('user{0}'))
+            roles = batch(Role, 2500, chunk_size=700, user_id=seq(start=1),
+                          smi_id=1)
+        self.assert_attr(DataSample, 'users', batch)
+        self.assertEqual(DataSample._sample_properties,
+                         ('newspaper', 'roles', 'users'))
+        counter = QueryCounter(self.session)
+        with counter:
+            sample = DataSample(self.session)
+            sample.create_all()
+        self.assertEqual(sample.users, 2500)
+        self.assertEqual(counter.count('insert', 'users'), 3)
+        self.assertEqual(counter.count('insert', 'roles'), 4)
+        self.assertEqual(self.session.query(User).count(), 2500)
+        self.assertEqual(self.session.query(User).get(2500).name,
+                         'user2499')
+        self.assertEqual(self.session.query(Role).get(1).smi.name,
+                         'newspaper')
+        # keys of rows without given ones are reserved and recorded
+        self.assertEqual(sample.created_idents[User],
+                         set((n,) for n in range(1, 2501)))
+        self.assertEqual(len(sample.created_idents[Role]), 2500)
+        self.assertEqual(sample.created_idents[Role],
+                         set(tuple(row) for row in
+                             self.session.query(Role.id)))
+
+    def test_sample_batch_bulk_creation(self):
+        engine = create_engine('sqlite:///:memory:', echo=False)
+        @event.listens_for(engine, 'connect')
+        def connect(dbapi_connection, connection_record):
+            dbapi_connection.execute('PRAGMA foreign_keys=ON')
+        metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        self.addCleanup(session.close)
+        class DataSample(Sample):
+            def john(self):
+                return User(id=1, name='john')
+            def newspaper(self):
+                return Smi(id=1, name='newspaper')
+            roles = batch(Role, 10, user_id=1, smi_id=1)
+        sample = DataSample(session)
+        with QueryCounter(session) as counter:
+            sample.create('john', 'newspaper', 'roles', bulk=True)
+        self.assertEqual(counter.count('INSERT', 'users'), 1)
+        self.assertEqual(counter.count('INSERT', 'smi'), 1)
+        self.assertEqual(counter.count('INSERT', 'roles'), 1)
+        self.assertEqual(session.query(Role).filter_by(user=sample.john)
+                         .count(), 10)
+
+    def test_sample_generator_property(self):
+        class DataSample(Sample):
+            chunk_size = 2
+            def newspaper(self):
+                return Smi(name='newspaper')
+            def users(self):
+                for i in range(5):
+                    yield Role(user=User(name='user%d' % i),
+                               smi=self.newspaper)
+        counter = QueryCounter(self.session)
+        with counter:
+            sample = DataSample(self.session)
+            sample.create_all()
+        self.assertEqual(sample.users, 5)
+        self.assertEqual(counter.commits, 4)
+        self.assertEqual(self.session.query(Role).count(), 5)
+        self.assertEqual(self.session.query(User).count(), 5)
+        self.assertEqual(len(self.session.identity_map), 1)
+        session = self.scoped_session(autocommit=True)
+        sample = DataSample(session)
+        sample.create_all(bulk=True)
+        self.assertEqual(sample.users, 5)
+        self.assertEqual(session.query(Role).count(), 5)
+        self.assertEqual(session.query(Smi).count(), 1)
+
+    def test_sample_seed(self):
+        class DataSample(Sample):
+            def cat1(self):
+                return Category(name=str(self.random.random()))
+            def cat2(self):
+                return Category(name=str(self.random.random()))
+        def names(**kwargs):
+            sample = DataSample(self.session, **kwargs)
+            sample.create_all()
+            return sample.cat1.name, sample.cat2.name
+        seeded = names(seed=1)
+        self.assertNotEqual(seeded[0], seeded[1])
+        # does not depend on PYTHONHASHSEED or interpreter
+        self.assertAlmostEqual(float(seeded[0]), 0.142933400037)
+        self.session.query(Category).delete()
+        self.assertEqual(names(seed=1), seeded)
+        self.session.query(Category).delete()
+        self.assertNotEqual(names(seed=2), seeded)
+        self.session.query(Category).delete()
+        sample = DataSample(self.session, seed=1)
+        sample.create('cat2')
+        self.assertEqual(sample.cat2.name, seeded[1])
+
+    def test_database_pool(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        template = create_engine(
+            'sqlite:///' + os.path.join(directory, 'template.sqlite'))
+        metadata.create_all(template)
+        template.execute(User.__table__.insert(), name='admin')
+        self.addCleanup(os.environ.pop, 'PYTEST_XDIST_WORKER', None)
+        for url in (None, 'sqlite://'):
+            pool = DatabasePool(template, url)
+            self.addCleanup(pool.dispose)
+            sessions = {}
+            for worker in ('gw0', 'gw1'):
+                os.environ['PYTEST_XDIST_WORKER'] = worker
+                sessions[worker] = pool.session()
+                self.assertEqual(sessions[worker].query(User.name).all(),
+                                 [('admin',)])
+            self.assertEqual(len(pool.engines), 2)
+            os.environ['PYTEST_XDIST_WORKER'] = 'gw0'
+            class DataSample(Sample):
+                def john(self):
+                    return User(name='john')
+            with Restorable(sessions['gw1']):
+                DataSample(sessions['gw1']).create_all()
+                self.assertEqual(sessions['gw1'].query(User).count(), 2)
+                self.assertEqual(sessions['gw0'].query(User).count(), 1)
+            self.assertEqual(sessions['gw1'].query(User).count(), 1)
+            sessions['gw0'].add(User(name='john'))
+            sessions['gw0'].commit()
+            pool.reset()
+            self.assertEqual(sessions['gw0'].query(User).count(), 1)
+            for session in sessions.values():
+                session.close()
+        self.assertEqual(sorted(os.listdir(directory)),
+                         ['template.sqlite', 'template_gw0.sqlite',
+                          'template_gw1.sqlite'])
+
+    def test_shared_database(self):
+        shared = SharedDatabase(metadata)
+        self.addCleanup(shared.dispose)
+        class DataSample(Sample):
+            def john(self):
+                return User(name='john')
+        engines = set()
+        for i in range(2):
+            counter = QueryCounter(shared.engine)
+            with counter:
+                with shared as session:
+                    engines.add(session.bind.engine)
+                    self.assertEqual(session.query(User).count(), 0)
+                    DataSample(session).create_all()
+                    session.add(User(name='bob'))
+                    session.commit()
+                    self.assertEqual(session.query(User).count(), 2)
+            self.assertEqual(counter.count('create'), 0)
+        self.assertEqual(engines, set([shared.engine]))
+        session = shared.isolate(self)
+        self.assertEqual(session.query(User).count(), 0)
+
+    @unittest.skipIf(AsyncSession is None, 'asyncio extension is required')
+    def test_async_session(self):
+        engine = create_async_engine('sqlite+aiosqlite:///:memory:')
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        run = loop.run_until_complete
+        session = AsyncSession(engine)
+        run(session.run_sync(
+            lambda db: metadata.create_all(db.connection())))
+        run(session.commit())
+        class DataSample(Sample):
+            def john(self):
+                return User(name='john')
+        namespace = {}
+        exec(ASYNC_SCENARIO, globals(), namespace)
+        scenario = namespace['async_scenario']
+        self.assertEqual(run(scenario(session, DataSample)), (['john'], 0))
+        run(session.close())
+        scoped = async_scoped_session(
+            sessionmaker(bind=engine, class_=AsyncSession),
+            scopefunc=lambda: None)
+        self.assertEqual(run(scenario(scoped, DataSample)), (['john'], 0))
+        run(scoped.remove())
+        run(engine.dispose())
+
+    def test_sample_dump_and_load(self):
+        class DataSample(Sample):
+            def john(self):
+                return User(name=u'J\xf6hn')
+            def categories(self):
+                return [Category(name='cat1'), Category(name='cat2')]
+            def newspaper_editor(self):
+                return Role(user=self.john, smi=Smi(name='newspaper'),
+                            categories=self.categories)
+            def label(self):
+                return Label(smi=self.newspaper_editor.smi, code='a')
+            users = batch(User, 5, id=seq(start=10), name=seq('user{0}'))
+            # keys of these rows are reserved by the sample
+            guests = batch(User, 3, name=seq('guest{0}'))
+        # rows not created by the sample are not dumped
+        other = Role(user=User(name='other'), smi=Smi(name='other'),
+                     categories=[Category(name='other')])
+        self.session.add(other)
+        self.session.commit()
+        sample = DataSample(self.session)
+        sample.create_all()
+        other.categories.append(sample.categories[0])
+        self.session.commit()
+        stream = StringIO()
+        dump_sample(sample, stream, chunk_size=2)
+        lines = stream.getvalue().splitlines()
+        headers = [json.loads(line) for line in lines if line[0] == '{']
+        self.assertEqual(set(header['table'] for header in headers),
+                         set(table.name for table in metadata.sorted_tables))
+        self.assertEqual(len(lines), len(headers) + 9 + 2 + 1 + 1 + 2 + 1)
+        session = self.Session(bind=create_engine('sqlite://'))
+        metadata.create_all(session.get_bind())
+        stream.seek(0)
+        counter = QueryCounter(session.get_bind())
+        with counter:
+            load_tables(session, stream, chunk_size=4)
+        self.assertEqual(counter.count('insert', 'users'), 3)
+        self.assertEqual(session.query(User)
+                         .filter(User.name.like('guest%')).count(), 3)
+        others = [other, other.user, other.smi, other.categories[0]]
+        self.session.execute(roles_category.delete().where(
+            roles_category.c.role_id == other.id))
+        for obj in others:
+            self.session.execute(obj.__table__.delete().where(
+                obj.__table__.c.id == obj.id))
+        self.session.commit()
+        for table in metadata.sorted_tables:
+            self.assertEqual(
+                session.execute(table.select()).fetchall(),
+                self.session.execute(table.select()).fetchall())
+        self.assertEqual(session.query(User).get(sample.john.id).name,
+                         u'J\xf6hn')
+        self.assertEqual(session.query(Role).one().categories[0].name,
+                         'cat1')
 
     def test_sample_method_overriding(self):
         class BaseTestSample(Sample):